@@ -20,24 +20,36 @@
 #===============================================================================
 
 import os
-import re
+import hashlib
 
-from functools import wraps
+from datetime import datetime
+from functools import wraps, partial
 from flask import (render_template, flash, redirect, url_for, request,
-                   send_from_directory)
+                   send_from_directory, jsonify, session, make_response)
+from werkzeug.http import is_resource_modified
 from flask.ext.login import (LoginManager, login_required, current_user,
                              login_user, logout_user)
 from flask.ext.wtf import Form
 from wtforms import (TextField, TextAreaField, PasswordField, HiddenField)
 from wtforms.validators import (Required, ValidationError, Email)
 
-from wiki import Wiki
+from wiki import Wiki, ForbiddenUrlError, urlify
+from tags import normalize
 from users import (UserManager, check_password, make_password,
                   get_default_authentication_method)
 import markup
+import highlight
+import renderpool
+from renderpool import RenderPool, RenderError
+import responsecache
+from responsecache import ResponseCache
+from assets import Assets
+import compression
+from compression import Compressor
 from extensions.cache import cache
-from signals import wiki_signals, page_saved, pre_display, pre_edit
-from . import core
+from signals import (wiki_signals, page_saved, page_moved, page_deleted,
+                     pre_display, pre_edit, collect_stats, display_etag)
+from . import core, STR_VERSION
 from .climanager import manager
 
 
@@ -58,6 +70,14 @@ CUSTOM_STATICS_DIR_NAME = "_custom"
 
 CUSTOM_STATICS_LIST = ["NAV_BAR_ICON", "FAVICON", "CUSTOM_CSS"]
 
+SEARCH_RESULTS_PER_PAGE = 20
+
+# how long the blocks of a preview revision are remembered
+PREVIEW_REVISION_TIMEOUT = 60 * 60
+
+# the user menu of each user is cached this long
+FRAGMENT_CACHE_TIMEOUT = 60 * 5
+
 PERMISSIONS_PUBLIC = "public"
 PERMISSIONS_PROTECTED = "protected"
 PERMISSIONS_PRIVATE = "private"
@@ -93,45 +113,65 @@ def protect(can_modify):
     return _dec
 
 
+def make_etag(*parts):
+    """Strong etag of a view output made of ``parts``. Responses also
+    depend on who is asking (menus, actions), on the code running and on
+    the asset bundles they link"""
+    user = current_user.get_id() if current_user.is_authenticated() else ''
+    seed = u'\n'.join([STR_VERSION, app.config.get('ETAG_SALT', ''),
+                       app.assets.version(), unicode(user)] +
+                      [unicode(p) for p in parts])
+    return hashlib.sha1(seed.encode('utf-8')).hexdigest()
+
+
+def conditional(etag, last_modified, render, cache_key=None):
+    """Answer 304 if the client already has this version (``etag``,
+    ``last_modified`` timestamp) of the view, or ``render()`` it. If
+    ``cache_key`` is given, anonymous readers get it from the response
+    cache"""
+    if (cache_key is not None and app.config.get('RESPONSE_CACHE', True)
+            and not current_user.is_authenticated()):
+        render = partial(response_cache.render, cache_key, etag, render)
+    if session.get('_flashes'):
+        # pending messages make this response unique
+        return render()
+    if last_modified is not None:
+        last_modified = datetime.utcfromtimestamp(last_modified)
+    if is_resource_modified(request.environ, etag=etag,
+                            last_modified=last_modified):
+        response = make_response(render())
+        if response.status_code != 200:
+            return response
+    else:
+        response = app.response_class(status=304)
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'no-cache'
+    response.vary.add('Cookie')
+    return response
+
+
+def user_menu_fragment():
+    user = current_user.get_id() if current_user.is_authenticated() else ''
+    key = 'fragment:user_menu:%s:%s' % (STR_VERSION, user)
+    html = cache.get(key)
+    if html is None:
+        html = render_template('snippets/user_menu.html')
+        cache.set(key, html, timeout=FRAGMENT_CACHE_TIMEOUT)
+    return html
+
+
+def flash_messages_fragment():
+    if not session.get('_flashes'):
+        return u''
+    return render_template('snippets/flash_messages.html')
+
+
 #===============================================================================
 # FORMS
 #===============================================================================
 
-class ForbiddenUrlError(ValueError):
-
-    def __init__(self, invalidpart, url):
-        self.invalidpart = invalidpart
-        self.url = url
-        super(ForbiddenUrlError, self).__init__(
-            "You can't create a page inside '{0}': {1}".format(invalidpart, url)
-        )
-
-    @property
-    def redirect(self):
-        if self.invalidpart.startswith("_"):
-            idx = self.url.index(self.invalidpart)
-            return "/" + self.url[:idx]
-        return self.invalidpart
-
-
-def urlify(url, protect_specials_url=True):
-    # Cleans the url and corrects various errors.
-    # Remove multiple spaces and leading and trailing spaces
-    if protect_specials_url:
-        if re.match(r'^(?i)(user|tag|create|search|index)', url):
-            invalid = url.replace('\\\\', '/').replace('\\', '/').split("/", 1)[0]
-            raise ForbiddenUrlError(invalid, url)
-        for p in url.replace('\\\\', '/').replace('\\', '/').split("/"):
-            if p in ("_edit"):
-                raise ForbiddenUrlError(p, url)
-
-    pretty_url = re.sub('[ ]{2,}', ' ', url).strip()
-    pretty_url = pretty_url.lower().replace('_', '-').replace(' ', '-')
-    # Corrects Windows style folders
-    pretty_url = pretty_url.replace('\\\\', '/').replace('\\', '/')
-    return pretty_url
-
-
 class URLForm(Form):
     url = TextField('', [Required()])
 
@@ -201,21 +241,44 @@ except IOError:
 
 app.config['CONTENT_DIR'] = os.path.join(app.config['DATA_DIR'], "content")
 app.config['CACHE_DIR'] = os.path.join(app.config['DATA_DIR'], "cache")
+app.config.setdefault('ASSETS_DIR',
+                      os.path.join(app.config['DATA_DIR'], "assets"))
 app.config['WIKI_ROOT'] = os.path.dirname(CONFIG_FILE_PATH)
 app.config['EDITOR_THEME'] = 'monokai'
 app.config['CUSTOM_STATICS_DIR_NAME'] = CUSTOM_STATICS_DIR_NAME
 app.config['CUSTOM_STATICS'] = {}
 
 
-cache.init_app(app, config={'CACHE_TYPE': 'filesystem',
-                            'CACHE_DIR': app.config["CACHE_DIR"]})
+# CACHE_TYPE, CACHE_THRESHOLD, etc. can be overridden from the config file
+cache_config = {'CACHE_TYPE': 'filesystem',
+                'CACHE_THRESHOLD': 20000,
+                'CACHE_DIR': app.config["CACHE_DIR"]}
+cache_config.update((key, value) for key, value in app.config.items()
+                    if key.startswith('CACHE_') and key != 'CACHE_DIR')
+cache.init_app(app, config=cache_config)
 loginmanager = LoginManager()
 loginmanager.init_app(app)
 loginmanager.login_view = 'user_login'
 markup = dict([(klass.NAME, klass) for klass in
                markup.Markup.__subclasses__()])[app.config.get('MARKUP')]
+markup.configure(app.config)
+highlight.install(app.config)
+collect_stats.connect(highlight.on_collect_stats)
+if app.config.get('RENDER_WORKERS'):
+    markup.pool = RenderPool(app.config['RENDER_WORKERS'],
+        app.config.get('RENDER_TIMEOUT', renderpool.DEFAULT_TIMEOUT),
+        app.config.get('RENDER_MAX_RSS', renderpool.DEFAULT_MAX_RSS))
+    collect_stats.connect(markup.pool.on_collect_stats)
+
+wiki = Wiki(app.config.get('CONTENT_DIR'), markup,
+            cache_dir=app.config.get('CACHE_DIR'))
+
+# pages could be changed while we were down (git pull, hgsync, etc)
+wiki.catalog.sync()
 
-wiki = Wiki(app.config.get('CONTENT_DIR'), markup)
+page_saved.connect(wiki.search_index.on_page_saved)
+page_moved.connect(wiki.search_index.on_page_moved)
+page_deleted.connect(wiki.search_index.on_page_deleted)
 
 # FIX ME: This monkeypatching is pollution crap .
 #         Should be possible to import them wherever,
@@ -228,8 +291,36 @@ app.manager = manager
 app.users = UserManager(app.config.get('DATA_DIR'), app)
 app.check_password = check_password
 app.make_password = make_password
-
-app.jinja_env.globals.update(user_can_edit=user_can_edit)
+app.assets = Assets(app.config['ASSETS_DIR'])
+
+app.jinja_env.globals.update(user_can_edit=user_can_edit,
+                             asset_url=app.assets.url,
+                             hole=responsecache.hole,
+                             editable_begin=responsecache.editable_begin,
+                             editable_end=responsecache.editable_end)
+
+response_cache = ResponseCache(
+    cache,
+    {'user_menu': user_menu_fragment,
+     'flash_messages': flash_messages_fragment},
+    user_can_edit,
+    app.config.get('RESPONSE_CACHE_TIMEOUT', responsecache.DEFAULT_TIMEOUT))
+app.response_cache = response_cache
+page_saved.connect(response_cache.on_page_saved)
+page_moved.connect(response_cache.on_page_moved)
+page_deleted.connect(response_cache.on_page_deleted)
+collect_stats.connect(response_cache.on_collect_stats)
+
+if app.config.get('COMPRESS', True):
+    compressor = Compressor(
+        cache,
+        app.config.get('COMPRESS_MIN_SIZE', compression.DEFAULT_MIN_SIZE),
+        app.config.get('COMPRESS_LEVEL', compression.DEFAULT_LEVEL),
+        app.config.get('COMPRESS_CACHE_TIMEOUT',
+                       compression.DEFAULT_TIMEOUT),
+        lambda: not current_user.is_authenticated())
+    compressor.init_app(app)
+    collect_stats.connect(compressor.on_collect_stats)
 
 #===============================================================================
 # VARIABLE STATIC FILE
@@ -266,6 +357,11 @@ def custom_static(filename):
     return send_from_directory(path, filename)
 
 
+@app.route('/_assets/<path:filename>')
+def asset(filename):
+    return app.assets.send(filename)
+
+
 @app.route('/')
 @protect(False)
 def home():
@@ -278,15 +374,19 @@ def home():
 @app.route('/index/')
 @protect(False)
 def index():
-    pages = wiki.index()
-    return render_template('index.html', pages=pages)
+    def render():
+        pages = wiki.index()
+        return render_template('index.html', pages=pages)
+    return conditional(make_etag('index', wiki.catalog.version()),
+                       wiki.catalog.mtime(), render,
+                       ResponseCache.key('index'))
 
 
 @app.route('/<path:url>/')
 @protect(False)
 def display(url):
-    page = wiki.get(url)
-    if not page:
+    fingerprint = wiki.fingerprint(url)
+    if fingerprint is None:
         try:
             pretyurl = urlify(url)
         except ForbiddenUrlError as err:
@@ -298,9 +398,19 @@ def display(url):
             flash('The page "{0}" does not exist, '
                   'feel free to make it now!'.format((url)), 'warning')
             return redirect(url_for('edit', url=pretyurl))
-    extra_context = {}
-    pre_display.send(page, user=current_user, extra_context=extra_context)
-    return render_template('page.html', page=page, **extra_context)
+
+    def render():
+        page = wiki.get_or_404(url)
+        extra_context = {}
+        pre_display.send(page, user=current_user, extra_context=extra_context)
+        return render_template('page.html', page=page, **extra_context)
+    content_hash, mtime = fingerprint
+    # receivers of display-etag answer whatever else, besides the
+    # source, the page shows (the last revision, for the Git extension)
+    extra = [result for receiver, result in
+             display_etag.send(url, path=wiki.path(url)) if result]
+    return conditional(make_etag('display', url, content_hash, *extra), mtime,
+                       render, ResponseCache.key('display', url))
 
 
 @app.route('/create/', methods=['GET', 'POST'])
@@ -329,7 +439,6 @@ def edit(url):
                 page = wiki.get_bare(url)
             form.populate_obj(page)
             page.save()
-            page.delete_cache()
             page_saved.send(page,
                             user=current_user,
                             message=form.message.data.encode('utf-8'))
@@ -346,9 +455,27 @@ def edit(url):
 @protect(True)
 def preview():
     a = request.form
-    data = {}
-    data['html'], data['body'], data['meta'] = markup(a['body']).process()
-    return data['html']
+    if 'rev' not in a:
+        try:
+            return markup(a['body']).render()
+        except RenderError as e:
+            return e.html
+
+    # incremental: the client sends the revision it's showing and
+    # gets back only the blocks it doesn't have
+    try:
+        blocks = markup(a['body']).blocks()
+    except RenderError as e:
+        return jsonify(rev='', blocks=['error'], html={'error': e.html})
+    ids = [block_id for block_id, html in blocks]
+    rev = hashlib.sha1(' '.join(ids)).hexdigest()
+    known = set()
+    if a['rev']:
+        known = set(cache.get('preview:' + a['rev']) or ())
+    cache.set('preview:' + rev, ids, timeout=PREVIEW_REVISION_TIMEOUT)
+    html = dict((block_id, block_html) for block_id, block_html in blocks
+                if block_id not in known)
+    return jsonify(rev=rev, blocks=ids, html=html)
 
 
 @app.route('/<path:url>/_move', methods=['GET', 'POST'])
@@ -359,6 +486,7 @@ def move(url):
     if form.validate_on_submit():
         newurl = form.url.data
         wiki.move(url, newurl)
+        page_moved.send(page, user=current_user, newurl=newurl)
         return redirect(url_for('.display', url=newurl))
     return render_template('move.html', form=form, page=page)
 
@@ -368,22 +496,42 @@ def move(url):
 def delete(url):
     page = wiki.get_or_404(url)
     wiki.delete(url)
+    page_deleted.send(page, user=current_user)
     flash('Page "%s" was deleted.' % page.title)
     return redirect(url_for('home'))
 
 
+def _tag_list(arg):
+    return [t for t in request.args.get(arg, '').split(',') if t.strip()]
+
+
 @app.route('/tags/')
 @protect(False)
 def tags():
-    tags = wiki.get_tags()
-    return render_template('tags.html', tags=tags)
+    def render():
+        tags = wiki.get_tags()
+        query = dict(all=_tag_list('all'), any=_tag_list('any'),
+                     exclude=_tag_list('not'))
+        pages = None
+        if any(query.values()):
+            pages = wiki.query_tags(**query)
+        return render_template('tags.html', tags=tags, pages=pages,
+                               query=query)
+    return conditional(make_etag('tags', wiki.catalog.version(),
+                            request.query_string),
+                       wiki.catalog.mtime(), render,
+                       ResponseCache.key('tags', request.query_string))
 
 
 @app.route('/tag/<string:name>/')
 @protect(False)
 def tag(name):
-    tagged = wiki.index_by_tag(name)
-    return render_template('tag.html', pages=tagged, tag=name)
+    def render():
+        tagged = wiki.index_by_tag(name)
+        return render_template('tag.html', pages=tagged, tag=name)
+    return conditional(make_etag('tag', name, wiki.catalog.version()),
+                       wiki.catalog.mtime(), render,
+                       ResponseCache.key('tag', normalize(name)))
 
 
 @app.route('/search/', methods=['GET', 'POST'])
@@ -391,10 +539,32 @@ def tag(name):
 def search():
     form = SearchForm()
     if form.validate_on_submit():
-        results = wiki.search(form.term.data)
-        return render_template('search.html', form=form,
-                               results=results, search=form.term.data)
-    return render_template('search.html', form=form, search=None)
+        return redirect(url_for('search', q=form.term.data))
+    term = request.args.get('q', '').strip()
+    if not term:
+        return render_template('search.html', form=form, search=None)
+    form.term.data = term
+    try:
+        page = max(int(request.args.get('page', 1)), 1)
+    except ValueError:
+        page = 1
+    per_page = app.config.get('SEARCH_RESULTS_PER_PAGE',
+                              SEARCH_RESULTS_PER_PAGE)
+    results, total = wiki.search(term, page, per_page)
+    pages = (total + per_page - 1) // per_page
+    return render_template('search.html', form=form, results=results,
+                           search=term, total=total, page=page, pages=pages)
+
+
+@app.route('/_stats/')
+@login_required
+def stats():
+    # every receiver of collect-stats answers a dict of counters. They
+    # are internal: only for logged in users, even on a public wiki
+    data = {}
+    for receiver, result in collect_stats.send(app):
+        data.update(result or {})
+    return jsonify(data)
 
 
 @app.route('/user/login/', methods=['GET', 'POST'])
@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013-2014, Martín Gaitán
+# Copyright (c) 2012-2013, Alexander Jung-Loddenkemper
+# This file is part of Waliki (http://waliki.nqnwebs.com/)
+# License: BSD (https://github.com/mgaitan/waliki/blob/master/LICENSE)
+
+#===============================================================================
+# DOCS
+#===============================================================================
+
+"""Static asset bundles
+
+``waliki build_assets`` concatenates and minifies the stylesheets and
+scripts every page loads into one file of each kind, named after a hash
+of its content, and stores a gzipped copy beside it. Images and fonts
+referenced from the stylesheets are copied (and renamed by content) too,
+so a bundle never points to a file that could change under its name.
+
+The output goes to ``ASSETS_DIR`` (``DATA_DIR/assets`` by default) with a
+``manifest.json`` mapping bundle names to file names. Templates ask
+:meth:`Assets.url` for a bundle and fall back to the individual files
+while nothing was built. Bundles are served with far future expiry
+headers: a new build means new names.
+
+Minification uses ``rcssmin`` and ``rjsmin`` when they are installed;
+otherwise stylesheets get a conservative whitespace and comment
+stripping and scripts are only concatenated.
+
+"""
+
+#===============================================================================
+# IMPORTS
+#===============================================================================
+
+import os
+import re
+import gzip
+import json
+import hashlib
+import mimetypes
+import threading
+
+from flask import url_for, request, send_file, abort, safe_join
+
+try:
+    import rcssmin
+except ImportError:
+    rcssmin = None
+
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None
+
+
+#===============================================================================
+# CONSTANTS
+#===============================================================================
+
+BUNDLES = (
+    ('waliki.css', ('css/bootstrap.css',
+                    'css/responsive.css',
+                    'css/pygments.css',
+                    'css/wiki.css',
+                    'codemirror/lib/codemirror.css',
+                    'font-awesome-4.0.3/css/font-awesome.min.css',
+                    'codemirror/addon/display/placeholder.css')),
+    ('waliki.js', ('js/bootstrap.min.js',
+                   'js/bootbox.min.js',
+                   'codemirror/lib/codemirror.js',
+                   'codemirror/addon/display/placeholder.js',
+                   'codemirror/mode/markdown/markdown.js',
+                   'codemirror/mode/rst/rst.js',
+                   'js/waliki.js')),
+)
+
+MANIFEST_FILENAME = 'manifest.json'
+
+# a year: bundles are never modified, only replaced by new names
+MAX_AGE = 60 * 60 * 24 * 365
+
+HASH_LENGTH = 12
+
+# gzipped copies are only kept if they save at least this fraction
+MIN_GZIP_SAVING = 0.1
+
+URL_RE = re.compile(r'''url\(\s*(['"]?)([^'"\)]+)\1\s*\)''')
+CSS_COMMENT_RE = re.compile(r'/\*(?!!).*?\*/', re.DOTALL)
+CSS_SPACES_RE = re.compile(r'\s+')
+CSS_PUNCTUATION_RE = re.compile(r'\s*([{};,])\s*')
+# a space before a colon can be a descendant selector: keep it
+CSS_COLON_RE = re.compile(r':\s+')
+
+
+#===============================================================================
+# MINIFIERS
+#===============================================================================
+
+def minify_css(css):
+    if rcssmin is not None:
+        return rcssmin.cssmin(css)
+    css = CSS_COMMENT_RE.sub('', css)
+    css = CSS_SPACES_RE.sub(' ', css)
+    css = CSS_PUNCTUATION_RE.sub(r'\1', css)
+    css = CSS_COLON_RE.sub(':', css)
+    return css.replace(';}', '}').strip()
+
+
+def minify_js(js):
+    if rjsmin is not None:
+        return rjsmin.jsmin(js)
+    return js.strip()
+
+
+#===============================================================================
+# BUILD
+#===============================================================================
+
+def fingerprint(name, content):
+    """``name`` with a hash of ``content`` before its extension"""
+    base, ext = os.path.splitext(name)
+    digest = hashlib.sha1(content).hexdigest()[:HASH_LENGTH]
+    return '%s.%s%s' % (base, digest, ext)
+
+
+def write(dest, name, content):
+    """Write ``content`` to ``dest/name`` and, if it's worth it, a
+    gzipped copy to ``dest/name.gz``. Return the size of both (None for
+    a missing gzipped copy)"""
+    path = os.path.join(dest, name)
+    with open(path, 'wb') as f:
+        f.write(content)
+    gz_path = path + '.gz'
+    # mtime=0 so the same content gives the same gzipped file
+    with open(gz_path, 'wb') as f:
+        gz = gzip.GzipFile(filename='', mode='wb', compresslevel=9,
+                           fileobj=f, mtime=0)
+        gz.write(content)
+        gz.close()
+    gz_size = os.path.getsize(gz_path)
+    if gz_size > len(content) * (1 - MIN_GZIP_SAVING):
+        os.remove(gz_path)
+        gz_size = None
+    return len(content), gz_size
+
+
+def build(static_dir, dest, bundles=BUNDLES):
+    """Build ``bundles`` from the files in ``static_dir`` into ``dest``
+    and write its manifest. Return ``{name: (filename, size, gz_size)}``
+    of every file written"""
+    if not os.path.isdir(dest):
+        os.makedirs(dest)
+    written = {}
+
+    def copy_referenced(css_path, match):
+        quote, target = match.groups()
+        if ':' in target or target.startswith(('/', '#')):
+            return match.group(0)       # absolute or data: url
+        path, sep, suffix = target.partition('?')
+        if not sep:
+            path, sep, suffix = target.partition('#')
+        source = os.path.normpath(
+            os.path.join(os.path.dirname(css_path), path))
+        with open(source, 'rb') as f:
+            content = f.read()
+        name = fingerprint(os.path.basename(source), content)
+        if name not in written:
+            written[name] = (name,) + write(dest, name, content)
+        return 'url(%s%s%s%s%s)' % (quote, name, sep, suffix, quote)
+
+    manifest = {}
+    for bundle, sources in bundles:
+        parts = []
+        for source in sources:
+            path = os.path.join(static_dir, source)
+            with open(path, 'rb') as f:
+                content = f.read()
+            if bundle.endswith('.css'):
+                content = URL_RE.sub(
+                    lambda m: copy_referenced(path, m), content)
+                parts.append(minify_css(content))
+            else:
+                # a script without a trailing semicolon mustn't be
+                # glued to the next one
+                parts.append(minify_js(content) + ';')
+        content = '\n'.join(parts)
+        name = fingerprint(bundle, content)
+        written[bundle] = (name,) + write(dest, name, content)
+        manifest[bundle] = name
+
+    tmp = os.path.join(dest, MANIFEST_FILENAME + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.rename(tmp, os.path.join(dest, MANIFEST_FILENAME))
+    return written
+
+
+def clean(dest, keep):
+    """Remove from ``dest`` the files not named in ``keep`` (nor their
+    gzipped copies). Return the names removed"""
+    keep = set(keep) | set(name + '.gz' for name in keep)
+    keep.add(MANIFEST_FILENAME)
+    removed = []
+    for name in sorted(os.listdir(dest)):
+        if name not in keep:
+            os.remove(os.path.join(dest, name))
+            removed.append(name)
+    return removed
+
+
+#===============================================================================
+# SERVING
+#===============================================================================
+
+class Assets(object):
+    """The bundles built into ``path``"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._manifest = {}
+        self._mtime = None
+
+    def manifest(self):
+        """The manifest of the last build, reloaded if it changed"""
+        try:
+            mtime = os.stat(os.path.join(self.path,
+                                         MANIFEST_FILENAME)).st_mtime
+        except OSError:
+            mtime = None
+        if mtime != self._mtime:
+            with self._lock:
+                manifest = {}
+                if mtime is not None:
+                    try:
+                        with open(os.path.join(self.path,
+                                               MANIFEST_FILENAME)) as f:
+                            manifest = json.load(f)
+                    except (IOError, ValueError):
+                        pass
+                self._manifest, self._mtime = manifest, mtime
+        return self._manifest
+
+    def version(self):
+        """A string that changes with each build"""
+        return u','.join(sorted(self.manifest().values()))
+
+    def url(self, bundle):
+        """URL of the built ``bundle``, or None if it wasn't built"""
+        name = self.manifest().get(bundle)
+        if name is None:
+            return None
+        return url_for('asset', filename=name)
+
+    def send(self, filename):
+        """Response with a built file, gzipped if the client accepts it"""
+        path = safe_join(self.path, filename)
+        if filename == MANIFEST_FILENAME or not os.path.isfile(path):
+            abort(404)
+        mimetype = mimetypes.guess_type(filename)[0] or \
+            'application/octet-stream'
+        gzipped = request.accept_encodings['gzip'] and \
+            os.path.isfile(path + '.gz')
+        response = send_file(path + '.gz' if gzipped else path,
+                             mimetype=mimetype, conditional=True,
+                             cache_timeout=MAX_AGE)
+        if gzipped:
+            response.headers['Content-Encoding'] = 'gzip'
+        response.vary.add('Accept-Encoding')
+        response.headers['Cache-Control'] = \
+            'public, max-age=%d, immutable' % MAX_AGE
+        return response
+
+
+#===============================================================================
+# MAIN
+#===============================================================================
+
+if __name__ == "__main__":
+    print(__doc__)
@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013-2014, Martín Gaitán
+# Copyright (c) 2012-2013, Alexander Jung-Loddenkemper
+# This file is part of Waliki (http://waliki.nqnwebs.com/)
+# License: BSD (https://github.com/mgaitan/waliki/blob/master/LICENSE)
+
+#===============================================================================
+# DOCS
+#===============================================================================
+
+"""Persistent catalog of pages metadata
+
+The catalog keeps, for each page of the wiki, what is needed to list it
+(url, title and tags) and to know if that data is stale (mtime, size and a
+hash of the source). Listing views read from here, so they never need to
+parse or render a page.
+
+"""
+
+#===============================================================================
+# IMPORTS
+#===============================================================================
+
+import os
+import json
+import hashlib
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:     # windows
+    fcntl = None
+
+
+#===============================================================================
+# FUNCTIONS
+#===============================================================================
+
+def checksum(data):
+    """Hash of the raw source of a page"""
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    return hashlib.sha1(data).hexdigest()
+
+
+def meta_value(meta, key, default=u'', sep=u' '):
+    """Flatten a meta value (a list of lines) into a single string"""
+    value = meta.get(key)
+    if not value:
+        return default
+    if isinstance(value, basestring):
+        return value
+    return sep.join(value)
+
+
+#===============================================================================
+# CATALOG CLASSES
+#===============================================================================
+
+class Entry(object):
+    """Metadata of one page as stored in the catalog"""
+
+    FIELDS = ('url', 'title', 'tags', 'mtime', 'size', 'hash')
+
+    def __init__(self, url, title=u'', tags=u'', mtime=0, size=0, hash=''):
+        self.url = url
+        self.title = title
+        self.tags = tags
+        self.mtime = mtime
+        self.size = size
+        self.hash = hash
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, self.url)
+
+    def to_dict(self):
+        return dict((field, getattr(self, field)) for field in self.FIELDS)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**dict((str(k), v) for k, v in data.items()))
+
+
+class Catalog(object):
+    """Index of pages metadata for a :class:`wiki.Wiki`, saved as json.
+
+    If ``path`` is None the catalog lives only in memory. Otherwise it is
+    reloaded every time the file is replaced, so many processes (i.e.
+    gunicorn workers) can share it.
+
+    """
+
+    def __init__(self, wiki, path=None):
+        self.wiki = wiki
+        self.path = path
+        self.generation = 0
+        self._entries = {}
+        self._stamp = None
+        self._loaded = False
+        self._lock = threading.RLock()
+        self._depth = 0
+
+    # persistence
+
+    def _file_stamp(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime, st.st_size)
+
+    def _read(self):
+        """(Re)load the catalog from disk if it was changed"""
+        if not self.path:
+            if not self._loaded:
+                self._loaded = True
+                self.sync()
+            return
+        stamp = self._file_stamp()
+        if stamp is None:
+            if not self._loaded:
+                self._loaded = True
+                self.sync()
+            return
+        if stamp == self._stamp:
+            return
+        try:
+            with open(self.path) as f:
+                data = json.loads(f.read())
+        except (IOError, ValueError):
+            # broken catalog: rebuild it from scratch
+            self._loaded = True
+            self._stamp = None
+            self._entries = {}
+            self.sync()
+            return
+        self.generation = data.get('generation', 0)
+        self._entries = dict((url, Entry.from_dict(value))
+                             for url, value in data.get('pages', {}).items())
+        self._stamp = stamp
+        self._loaded = True
+
+    def _write(self):
+        self.generation += 1
+        if not self.path:
+            return
+        folder = os.path.dirname(self.path)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        data = {'generation': self.generation,
+                'pages': dict((url, entry.to_dict())
+                              for url, entry in self._entries.items())}
+        tmp = '%s.%s.tmp' % (self.path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(json.dumps(data))
+        os.rename(tmp, self.path)
+        self._stamp = self._file_stamp()
+
+    @contextmanager
+    def _transaction(self):
+        """Serialize read-modify-write cycles among threads and processes"""
+        with self._lock:
+            lockfile = None
+            self._depth += 1
+            if self.path and fcntl is not None and self._depth == 1:
+                folder = os.path.dirname(self.path)
+                if not os.path.exists(folder):
+                    os.makedirs(folder)
+                lockfile = open(self.path + '.lock', 'w')
+                fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                self._read()
+                yield
+            finally:
+                self._depth -= 1
+                if lockfile is not None:
+                    fcntl.flock(lockfile, fcntl.LOCK_UN)
+                    lockfile.close()
+
+    # reading
+
+    def entries(self):
+        with self._lock:
+            self._read()
+            return self._entries.values()
+
+    def get(self, url):
+        with self._lock:
+            self._read()
+            return self._entries.get(url)
+
+    def __len__(self):
+        return len(self.entries())
+
+    def version(self):
+        """Return a string that changes every time the catalog does"""
+        with self._lock:
+            self._read()
+            return '%s:%s' % (self.generation, self._stamp)
+
+    def mtime(self):
+        """Return when the catalog was last written, or None if it lives
+        only in memory"""
+        with self._lock:
+            self._read()
+            return self._stamp[1] if self._stamp else None
+
+    # updating
+
+    def _entry_for(self, url, path, meta=None):
+        st = os.stat(path)
+        with open(path, 'rU') as f:
+            raw = f.read()
+        if meta is None:
+            meta = self.wiki.markup.read_meta(raw.decode('utf-8'))[0]
+        return Entry(url,
+                     title=meta_value(meta, 'title', default=url),
+                     tags=meta_value(meta, 'tags', sep=u', '),
+                     mtime=st.st_mtime,
+                     size=st.st_size,
+                     hash=checksum(raw))
+
+    def update(self, url, meta=None):
+        """Refresh the entry of ``url`` after its file was written"""
+        path = self.wiki.path(url)
+        with self._transaction():
+            if os.path.exists(path):
+                self._entries[url] = self._entry_for(url, path, meta)
+            else:
+                self._entries.pop(url, None)
+            self._write()
+
+    def move(self, url, newurl):
+        with self._transaction():
+            entry = self._entries.pop(url, None)
+            path = self.wiki.path(newurl)
+            if entry is not None and os.path.exists(path):
+                entry.url = newurl
+                self._entries[newurl] = entry
+            elif os.path.exists(path):
+                self._entries[newurl] = self._entry_for(newurl, path)
+            self._write()
+
+    def remove(self, url):
+        with self._transaction():
+            if self._entries.pop(url, None) is not None:
+                self._write()
+
+    def sync(self):
+        """Check the catalog against the files on disk.
+
+        Only pages whose mtime or size changed are read again. Return the
+        list of urls added, updated or removed.
+
+        """
+        with self._transaction():
+            changed = []
+            seen = set()
+            for path, url in self.wiki.walk():
+                seen.add(url)
+                entry = self._entries.get(url)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if (entry is not None and entry.mtime == st.st_mtime and
+                        entry.size == st.st_size):
+                    continue
+                self._entries[url] = self._entry_for(url, path)
+                changed.append(url)
+            for url in set(self._entries) - seen:
+                del self._entries[url]
+                changed.append(url)
+            if changed or self._stamp is None:
+                self._write()
+            return changed
+
+
+#===============================================================================
+# MAIN
+#===============================================================================
+
+if __name__ == "__main__":
+    print(__doc__)
@@ -20,14 +20,18 @@
 
 import codecs
 import os
+import re
+import sys
 import random
 import hashlib
 import time
 import codecs
 import shutil
+import multiprocessing
 
 import jinja2
 
+from flask import current_app
 from flask.ext import script
 
 from . import core
@@ -119,6 +123,45 @@ DATA_DIR = '{{datadir}}'
 # restructuredtext or markdown
 MARKUP = '{{ markup }}'
 
+# Python-Markdown extensions, if MARKUP is markdown. Keep 'meta':
+# it strips the title and tags header from the output
+# MARKDOWN_EXTENSIONS = ['codehilite', 'fenced_code', 'meta']
+
+# Markdown implementation: python-markdown (default), mistune or
+# markdown2. Compare them with `waliki benchmark`
+# MARKDOWN_ENGINE = 'python-markdown'
+
+# Highlighted code is cached in memory (bytes, 0 disables it) and,
+# optionally, under CACHE_DIR
+# HIGHLIGHT_CACHE_SIZE = 32 * 1024 * 1024
+# HIGHLIGHT_CACHE_PERSIST = False
+
+# Render pages in this many worker processes, killing renders that take
+# longer than RENDER_TIMEOUT seconds or RENDER_MAX_RSS megabytes
+# RENDER_WORKERS = 2
+# RENDER_TIMEOUT = 10
+# RENDER_MAX_RSS = 256
+
+# Pages, index and tags answer 304 Not Modified to clients that already
+# have them. Change this after customizing templates to invalidate them
+# ETAG_SALT = ''
+
+# Anonymous readers get pages, index and tags from a response cache,
+# invalidated when pages change
+# RESPONSE_CACHE = True
+# RESPONSE_CACHE_TIMEOUT = 60 * 60 * 24
+
+# `waliki build_assets` bundles the static files here, served with far
+# future expiry headers. Run it again after upgrading waliki
+# ASSETS_DIR = DATA_DIR + '/assets'
+
+# Responses bigger than COMPRESS_MIN_SIZE bytes are gzipped (zlib level
+# COMPRESS_LEVEL, 1-9) for clients that accept it. Leave it to the web
+# server with COMPRESS = False
+# COMPRESS = True
+# COMPRESS_MIN_SIZE = 500
+# COMPRESS_LEVEL = 6
+
 # PERMISSIONS can be:
 #   public: everybody can read and write a page (default)
 #   protected: anyone can view but only registered users can write
@@ -312,10 +355,269 @@ def startwiki(dest):
     print("Your Wiki is ready!")
 
 
+@manager.option('-j', '--jobs', dest='jobs', type=int, default=None,
+                help='Number of render processes (default: one per cpu)')
+@manager.option('-o', '--only-changed', dest='only_changed',
+                action='store_true', default=False,
+                help='Skip the pages whose rendered artifact is up to date')
+def warmup(jobs=None, only_changed=False):
+    """Render every page and fill the render cache and the catalog"""
+    from .extensions.cache import cache
+    from .wiki import RENDER_CACHE_TIMEOUT
+
+    wiki = current_app.wiki
+    changed = wiki.catalog.sync()
+    print("Catalog synced: {} pages changed".format(len(changed)))
+
+    jobs = jobs or multiprocessing.cpu_count()
+    tasks = [(wiki.markup, url, path, wiki.artifacts, only_changed)
+             for path, url in wiki.walk()]
+    total = len(tasks)
+    rendered = skipped = 0
+    failed = []
+    slowest = (0, None)
+    started = time.time()
+    pool = multiprocessing.Pool(jobs)
+    try:
+        results = pool.imap_unordered(render_page, tasks, chunksize=4)
+        for done, (url, key, html, meta, elapsed) in enumerate(results, 1):
+            if key is None:
+                failed.append((url, meta))
+            elif html is None:
+                skipped += 1
+            else:
+                rendered += 1
+                cache.set(key, html, timeout=RENDER_CACHE_TIMEOUT)
+                if wiki.artifacts is not None:
+                    wiki.artifacts.write(url, key, html, meta)
+                slowest = max(slowest, (elapsed, url))
+            rate = done / max(time.time() - started, 1e-6)
+            sys.stdout.write("\r{}/{} pages ({:.1f} pages/s)".format(
+                done, total, rate))
+            sys.stdout.flush()
+    finally:
+        pool.close()
+        pool.join()
+
+    elapsed = time.time() - started
+    print("\nRendered {} pages, skipped {} up to date, in {:.1f}s "
+          "with {} processes ({:.1f} pages/s)".format(
+              rendered, skipped, elapsed, jobs, total / max(elapsed, 1e-6)))
+    if slowest[1]:
+        print("Slowest page: {} ({:.2f}s)".format(slowest[1], slowest[0]))
+    for url, err in failed:
+        print(u"Failed to render {}: {}".format(url, err))
+
+
+@manager.option('-c', '--clean', dest='clean', action='store_true',
+                default=False,
+                help='Remove the files of previous builds')
+def build_assets(clean=False):
+    """Bundle, minify, fingerprint and gzip the static files"""
+    from . import assets
+
+    dest = current_app.config['ASSETS_DIR']
+    written = assets.build(current_app.static_folder, dest)
+    for name, (filename, size, gz_size) in sorted(written.items()):
+        if gz_size is None:
+            print("{}: {} ({} bytes)".format(name, filename, size))
+        else:
+            print("{}: {} ({} bytes, {} gzipped)".format(
+                name, filename, size, gz_size))
+    if clean:
+        removed = assets.clean(dest, [filename for filename, size, gz_size
+                                      in written.values()])
+        print("Removed {} files of previous builds".format(len(removed)))
+    print("Assets built into {}".format(dest))
+
+
+@manager.option('-n', '--repeat', dest='repeat', type=int, default=3,
+                help='Times each document is rendered')
+@manager.option('-c', '--corpus', dest='corpus', type=int, default=0,
+                help='Generate this many documents instead of using '
+                     'the wiki pages')
+@manager.option('-e', '--engines', dest='engines', default=None,
+                help='Comma separated markdown engines '
+                     '(default: every installed one)')
+@manager.option('-d', '--diff', dest='diff', action='store_true',
+                default=False,
+                help='Show the first difference of each engine')
+def benchmark(repeat=3, corpus=0, engines=None, diff=False):
+    """Compare the markdown engines: renders per second, and how many
+    documents each one renders like python-markdown does. python-markdown
+    is also measured building a converter for each render"""
+    import difflib
+    import textwrap
+    from .markup import Markdown, markdown_engines
+
+    installed = markdown_engines()
+    names = engines.split(',') if engines else sorted(installed)
+    for name in names:
+        if name not in installed:
+            print("Unknown or not installed engine: {}".format(name))
+            return
+    reference = 'python-markdown'
+    if reference in names:
+        names.remove(reference)
+    names.insert(0, reference)
+
+    wiki = getattr(current_app, 'wiki', None)
+    if corpus:
+        sources = generate_corpus(corpus)
+    elif wiki is not None and wiki.markup is Markdown:
+        sources = []
+        for path, url in wiki.walk():
+            with open(path, 'rU') as f:
+                sources.append(f.read().decode('utf-8'))
+    else:
+        sources = [textwrap.dedent(Markdown.HOWTO)]
+    print("{} documents, {} rounds, extensions: {}".format(
+        len(sources), repeat, ", ".join(Markdown.EXTENSIONS)))
+    print("{:>34} {:>12} {:>10} {:>10} {:>10}".format(
+        "engine", "renders/s", "identical", "similar", "different"))
+
+    def fresh(source):
+        # a converter built for each render, as waliki used to
+        return installed[reference](list(Markdown.EXTENSIONS)).convert(source)
+
+    runs = []
+    for name in names:
+        runs.append((name, Markdown.engine(name=name).convert))
+        if name == reference:
+            runs.append(("{} (fresh converter)".format(name), fresh))
+
+    expected = None
+    for name, render in runs:
+        outputs = [render(source) for source in sources]
+        if expected is None:
+            expected = outputs
+        rate = renders_per_second(render, sources, repeat)
+        identical = similar = 0
+        first_diff = None
+        for index, (html, reference_html) in enumerate(zip(outputs, expected)):
+            if html == reference_html:
+                identical += 1
+            elif normalize_html(html) == normalize_html(reference_html):
+                similar += 1
+            elif first_diff is None:
+                first_diff = index
+        different = len(sources) - identical - similar
+        print("{:>34} {:12.1f} {:10d} {:10d} {:10d}".format(
+            name, rate, identical, similar, different))
+        if diff and first_diff is not None:
+            lines = difflib.unified_diff(
+                expected[first_diff].splitlines(),
+                outputs[first_diff].splitlines(),
+                reference, name, lineterm='')
+            for line in list(lines)[:40]:
+                print(u"    " + line)
+
+
 #===============================================================================
 # FUNCTIONS
 #===============================================================================
 
+def renders_per_second(render, sources, repeat):
+    render(sources[0])      # warm imports up
+    started = time.time()
+    for _ in range(repeat):
+        for source in sources:
+            render(source)
+    return len(sources) * repeat / max(time.time() - started, 1e-6)
+
+
+def normalize_html(html):
+    """Return ``html`` without the differences a browser doesn't show:
+    whitespace between tags and self closing slashes"""
+    html = re.sub(r'\s*/>', '>', html)
+    html = re.sub(r'>\s+', '>', html)
+    html = re.sub(r'\s+<', '<', html)
+    return re.sub(r'\s+', ' ', html).strip()
+
+
+CORPUS_WORDS = (u"wiki page markdown render engine speed code python "
+                u"function value list item link table header text waliki "
+                u"cache index search user commit history").split()
+
+
+def generate_corpus(count, seed=0):
+    """Return ``count`` markdown documents mixing every common construct,
+    always the same for the same seed"""
+    rand = random.Random(seed)
+
+    def words(low, high):
+        return u" ".join(rand.choice(CORPUS_WORDS)
+                         for _ in range(rand.randint(low, high)))
+
+    def paragraph():
+        parts = []
+        for _ in range(rand.randint(2, 6)):
+            kind = rand.randint(0, 5)
+            if kind == 1:
+                parts.append(u"*%s*" % words(1, 3))
+            elif kind == 2:
+                parts.append(u"**%s**" % words(1, 2))
+            elif kind == 3:
+                parts.append(u"`%s()`" % rand.choice(CORPUS_WORDS))
+            elif kind == 4:
+                parts.append(u"[%s](/%s)" % (words(1, 2),
+                                             rand.choice(CORPUS_WORDS)))
+            parts.append(words(3, 12))
+        return u" ".join(parts) + u"."
+
+    def code():
+        name = rand.choice(CORPUS_WORDS)
+        lines = [u"def %s(x):" % name]
+        for i in range(rand.randint(1, 8)):
+            lines.append(u"    x = x * %d + len(%r)" % (i, name))
+        lines.append(u"    return x")
+        return u"\n".join(lines)
+
+    blocks = [
+        lambda: u"# %s" % words(1, 4).capitalize(),
+        lambda: u"## %s" % words(1, 4).capitalize(),
+        paragraph, paragraph, paragraph,
+        lambda: u"\n".join(u"* %s" % words(2, 8)
+                           for _ in range(rand.randint(2, 6))),
+        lambda: u"\n".join(u"%d. %s" % (i + 1, words(2, 8))
+                           for i in range(rand.randint(2, 6))),
+        lambda: u"> %s" % paragraph(),
+        lambda: u"```python\n%s\n```" % code(),
+        lambda: u"\n".join(u"    " + line
+                           for line in code().splitlines()),
+        lambda: u"---",
+    ]
+    documents = []
+    for number in range(count):
+        body = [rand.choice(blocks)() for _ in range(rand.randint(5, 30))]
+        documents.append(u"title: Page %d\ntags: %s\n\n%s\n" % (
+            number, words(1, 3).replace(u" ", u", "), u"\n\n".join(body)))
+    return documents
+
+
+def render_page(task):
+    """Render one page for :func:`warmup`. Runs in a worker process"""
+    markup, url, path, artifacts, only_changed = task
+    started = time.time()
+    try:
+        with open(path, 'rU') as f:
+            content = markup(f.read().decode('utf-8'))
+    except (IOError, UnicodeDecodeError) as err:
+        # unreadable or not utf-8: reported like a render failure
+        return url, None, None, err, time.time() - started
+    key = content.cache_key()
+    if (only_changed and artifacts is not None and
+            artifacts.read(url, key) is not None):
+        return url, key, None, None, 0
+    try:
+        html = content.process()[0]
+    except Exception as err:
+        # reported by warmup, a broken page shouldn't stop the others
+        return url, None, None, err, time.time() - started
+    meta = markup.read_meta(content.raw_content)[0]
+    return url, key, html, meta, time.time() - started
+
+
 def make_secret_key():
     buff = []
 
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013-2014, Martín Gaitán
+# Copyright (c) 2012-2013, Alexander Jung-Loddenkemper
+# This file is part of Waliki (http://waliki.nqnwebs.com/)
+# License: BSD (https://github.com/mgaitan/waliki/blob/master/LICENSE)
+
+#===============================================================================
+# DOCS
+#===============================================================================
+
+"""Response compression
+
+:class:`Compressor` gzips (or deflates) the html, json, css and javascript
+the app answers to clients that accept it. Compressed bodies are cached
+keyed by encoding, level and a hash of the uncompressed body, so a page
+everybody reads is compressed once, not on every request.
+
+A compressed response is another representation of the resource, so its
+etag gets the encoding as a suffix (``"<etag>-gzip"``). The suffix is
+taken out of ``If-None-Match`` before the views see it, so they keep
+answering 304 to clients holding the compressed version.
+
+"""
+
+#===============================================================================
+# IMPORTS
+#===============================================================================
+
+import re
+import zlib
+import hashlib
+
+from flask import request
+
+
+#===============================================================================
+# CONSTANTS
+#===============================================================================
+
+DEFAULT_MIN_SIZE = 500          # bytes
+DEFAULT_LEVEL = 6
+DEFAULT_TIMEOUT = 60 * 60 * 24
+
+# preferred first
+ENCODINGS = ('gzip', 'deflate')
+
+COMPRESSIBLE = frozenset(['text/html', 'text/css', 'text/plain',
+                          'text/javascript', 'application/javascript',
+                          'application/json', 'application/xml',
+                          'text/xml'])
+
+ETAG_SUFFIX_RE = re.compile(r'-(%s)(?="|$)' % '|'.join(ENCODINGS))
+
+
+#===============================================================================
+# COMPRESSORS
+#===============================================================================
+
+def compress(data, encoding, level=DEFAULT_LEVEL):
+    """``data`` compressed with ``encoding``"""
+    if encoding == 'gzip':
+        # wbits 16 + MAX_WBITS: a gzip header and trailer around it
+        compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+    else:
+        compressor = zlib.compressobj(level)
+    return compressor.compress(data) + compressor.flush()
+
+
+def choose_encoding(accept_encodings):
+    """The best of :data:`ENCODINGS` for an ``Accept-Encoding``, or
+    None"""
+    best = max(ENCODINGS, key=lambda e: accept_encodings[e])
+    return best if accept_encodings[best] else None
+
+
+#===============================================================================
+# MIDDLEWARE
+#===============================================================================
+
+class Compressor(object):
+    """Compresses the responses of an app.
+
+    Compressed bodies are stored in ``cache`` when ``cacheable()`` is
+    true for the request (bodies made for a single user would be never
+    read again).
+
+    """
+
+    def __init__(self, cache, min_size=DEFAULT_MIN_SIZE, level=DEFAULT_LEVEL,
+                 timeout=DEFAULT_TIMEOUT, cacheable=lambda: True):
+        self.cache = cache
+        self.min_size = min_size
+        self.level = level
+        self.timeout = timeout
+        self.cacheable = cacheable
+        self.hits = self.misses = self.uncached = 0
+        self.bytes_in = self.bytes_out = 0
+
+    def init_app(self, app):
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+
+    def key(self, body, encoding):
+        return 'compressed:%s:%s:%s' % (hashlib.sha1(body).hexdigest(),
+                                        encoding, self.level)
+
+    def compressed(self, body, encoding):
+        if not self.cacheable():
+            self.uncached += 1
+            return compress(body, encoding, self.level)
+        key = self.key(body, encoding)
+        data = self.cache.get(key)
+        if data is not None:
+            self.hits += 1
+            return data
+        self.misses += 1
+        data = compress(body, encoding, self.level)
+        self.cache.set(key, data, timeout=self.timeout)
+        return data
+
+    def before_request(self):
+        if_none_match = request.environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            match = ETAG_SUFFIX_RE.search(if_none_match)
+            if match:
+                # the encoding of the representation the client holds
+                request.environ['waliki.etag_encoding'] = match.group(1)
+                request.environ['HTTP_IF_NONE_MATCH'] = \
+                    ETAG_SUFFIX_RE.sub('', if_none_match)
+
+    def after_request(self, response):
+        if (response.mimetype not in COMPRESSIBLE
+                or response.direct_passthrough or response.is_streamed
+                or 'Content-Encoding' in response.headers):
+            return response
+        response.vary.add('Accept-Encoding')
+        etag, weak = response.get_etag()
+        if response.status_code == 304:
+            encoding = request.environ.get('waliki.etag_encoding')
+        elif response.status_code == 200:
+            encoding = choose_encoding(request.accept_encodings)
+            body = response.data
+            if encoding is None or len(body) < self.min_size:
+                return response
+            data = self.compressed(body, encoding)
+            self.bytes_in += len(body)
+            self.bytes_out += len(data)
+            response.data = data
+            response.headers['Content-Encoding'] = encoding
+        else:
+            return response
+        if etag and encoding:
+            response.set_etag('%s-%s' % (etag, encoding), weak)
+        return response
+
+    # signal receivers
+
+    def on_collect_stats(self, sender, **extra):
+        return {'compression': {'hits': self.hits,
+                                'misses': self.misses,
+                                'uncached': self.uncached,
+                                'bytes_in': self.bytes_in,
+                                'bytes_out': self.bytes_out}}
+
+
+#===============================================================================
+# MAIN
+#===============================================================================
+
+if __name__ == "__main__":
+    print(__doc__)
@@ -12,6 +12,14 @@
 
 """Extension for use git as storage backend.
 
+Settings:
+
+- ``GIT_COMMIT_WINDOW``: saves are committed in the background, those
+  made within this many seconds together (default 2). 0 commits each
+  save before answering the request.
+- ``GIT_HISTORY_PER_PAGE``: entries in each page of a history (50).
+- ``GIT_BLOB_CACHE_SIZE``: bytes of page versions kept in memory (16 MB).
+
 """
 
 
@@ -21,12 +29,21 @@
 
 import os
 import re
+import time
+import atexit
+import threading
+import subprocess
+import collections
+from datetime import datetime
+from difflib import SequenceMatcher
 from flask import (Blueprint, render_template, current_app,
                    request, url_for, redirect, abort)
+from jinja2 import escape
 from git import *
 from gitdb import IStream
 from StringIO import StringIO
-import json
+
+from waliki.extensions.cache import cache
 
 
 #===============================================================================
@@ -36,13 +53,376 @@ import json
 gitplugin = Blueprint('gitplugin', __name__, template_folder='templates')
 
 
+#===============================================================================
+# CONSTANTS
+#===============================================================================
+
+HISTORY_PER_PAGE = 50
+
+# pages whose history is kept in memory
+HISTORY_CACHE_SIZE = 500
+
+HISTORY_FORMAT = '%x01' + '%x00'.join(['%H', '%h', '%an', '%ad', '%at', '%s'])
+
+# the diff of two blobs never changes
+DIFF_CACHE_TIMEOUT = 60 * 60 * 24 * 365
+
+DIFF_CONTEXT = 3
+
+# sha of the empty blob: what a page was before it existed
+EMPTY_BLOB = 'e69de29bb2d1d6434b8b29ae775ad8c2e48c5391'
+
+# an abbreviated or full commit sha, as the diff urls take
+COMMIT_RE = re.compile(r'^[0-9a-f]{4,40}$')
+
+WORD_RE = re.compile(r'\s+|\w+|[^\w\s]', re.UNICODE)
+
+DEFAULT_BLOB_CACHE_SIZE = 16 * 1024 * 1024
+
+# seconds saves wait for others to be committed with
+DEFAULT_COMMIT_WINDOW = 2
+
+# times a queued save is tried before it is dropped
+COMMIT_ATTEMPTS = 3
+
+
 #===============================================================================
 # HELPERS
 #===============================================================================
 
+RELATIVE_DATE_UNITS = ((60 * 60 * 24 * 365, 'year'),
+                       (60 * 60 * 24 * 30, 'month'),
+                       (60 * 60 * 24 * 7, 'week'),
+                       (60 * 60 * 24, 'day'),
+                       (60 * 60, 'hour'),
+                       (60, 'minute'),
+                       (1, 'second'))
+
+
+def relative_date(timestamp, now=None):
+    """How long ago was ``timestamp``, the way ``--date=relative``
+    tells it"""
+    seconds = max(int((now or time.time()) - timestamp), 0)
+    for size, unit in RELATIVE_DATE_UNITS:
+        if seconds >= size or size == 1:
+            count = seconds // size
+            return u'%d %s%s ago' % (count, unit, '' if count == 1 else 's')
+
+
+def _changed(cls, text):
+    return u'<span class="%s">%s</span>' % (cls, escape(text))
+
+
+def word_diff(old, new):
+    """Html of ``new`` with the words deleted from ``old`` and the ones
+    inserted marked. Lines are matched first, so only the changed
+    stretches are compared word by word"""
+    old_lines, new_lines = old.splitlines(True), new.splitlines(True)
+    matcher = SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    html = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        old_text = u''.join(old_lines[i1:i2])
+        new_text = u''.join(new_lines[j1:j2])
+        if tag == 'equal':
+            html.append(escape(new_text))
+        elif tag == 'replace':
+            old_words = WORD_RE.findall(old_text)
+            new_words = WORD_RE.findall(new_text)
+            words = SequenceMatcher(None, old_words, new_words, autojunk=False)
+            for tag, k1, k2, l1, l2 in words.get_opcodes():
+                if tag == 'equal':
+                    html.append(escape(u''.join(new_words[l1:l2])))
+                    continue
+                if k2 > k1:
+                    html.append(_changed('del', u''.join(old_words[k1:k2])))
+                if l2 > l1:
+                    html.append(_changed('ins', u''.join(new_words[l1:l2])))
+        else:
+            if old_text:
+                html.append(_changed('del', old_text))
+            if new_text:
+                html.append(_changed('ins', new_text))
+    return u'<div class="diff diff-words monospace">%s</div>' % u''.join(html)
+
+
+def line_diff(old, new, context=DIFF_CONTEXT):
+    """Html table with the changed lines and ``context`` lines around
+    them, numbered"""
+    old_lines, new_lines = old.splitlines(), new.splitlines()
+    matcher = SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    row = u'<tr class="%s"><td>%s</td><td>%s</td><td>%s</td></tr>'
+    rows = []
+    for group in matcher.get_grouped_opcodes(context):
+        i1, i2 = group[0][1], group[-1][2]
+        j1, j2 = group[0][3], group[-1][4]
+        rows.append(u'<tr class="diff-hunk"><td colspan="3">'
+                    u'@@ -%d,%d +%d,%d @@</td></tr>'
+                    % (i1 + 1, i2 - i1, j1 + 1, j2 - j1))
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                for k in range(i2 - i1):
+                    rows.append(row % ('', i1 + k + 1, j1 + k + 1,
+                                       escape(old_lines[i1 + k])))
+                continue
+            for k in range(i1, i2):
+                rows.append(row % ('diff-del', k + 1, u'',
+                                   escape(old_lines[k])))
+            for k in range(j1, j2):
+                rows.append(row % ('diff-ins', u'', k + 1,
+                                   escape(new_lines[k])))
+    if not rows:
+        return u'<p class="muted">No differences</p>'
+    return (u'<table class="table table-condensed diff diff-lines monospace">'
+            u'<tbody>%s</tbody></table>' % u''.join(rows))
+
+
+DIFFS = collections.OrderedDict([('words', word_diff), ('lines', line_diff)])
+
+
+class CatFile(object):
+    """A long lived ``git cat-file --batch`` process (``--batch-check``
+    with ``check``) answering object lookups without a fork each.
+    Each forked worker starts its own"""
+
+    def __init__(self, repo_dir, check=False):
+        self.repo_dir = repo_dir
+        self.check = check
+        self._lock = threading.Lock()
+        self._process = None
+        self._pid = None
+
+    def _start(self):
+        self._process = subprocess.Popen(
+            ['git', 'cat-file', '--batch-check' if self.check else '--batch'],
+            cwd=self.repo_dir, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self._pid = os.getpid()
+
+    def _ask(self, name):
+        if (self._pid != os.getpid() or self._process is None
+                or self._process.poll() is not None):
+            self._start()
+        self._process.stdin.write(name + '\n')
+        self._process.stdin.flush()
+        header = self._process.stdout.readline()
+        if not header:
+            raise IOError('git cat-file exited')
+        if header.endswith(' missing\n'):
+            return None
+        sha, type_, size = header.split()
+        if self.check:
+            return sha, type_, int(size)
+        data = self._process.stdout.read(int(size))
+        self._process.stdout.read(1)        # the newline after the data
+        return sha, type_, data
+
+    def query(self, name):
+        """``(sha, type, data)`` (``(sha, type, size)`` with ``check``)
+        of the object ``name`` (a sha, or ``<rev>:<path>``), or None if
+        there is no such object"""
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        if '\n' in name:
+            return None
+        with self._lock:
+            try:
+                return self._ask(name)
+            except (IOError, OSError, ValueError):
+                # the process died, or the pipe is out of sync: retry
+                # once with a new one
+                self.close()
+                return self._ask(name)
+
+    def close(self):
+        if self._process is not None and self._pid == os.getpid():
+            try:
+                self._process.stdin.close()
+                self._process.wait()
+            except (IOError, OSError):
+                pass
+        self._process = None
+
+
+class BlobCache(object):
+    """LRU of blob contents by sha, bounded by size. Blobs never change,
+    so entries never get stale"""
+
+    def __init__(self, max_size=DEFAULT_BLOB_CACHE_SIZE):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._blobs = collections.OrderedDict()
+        self.size = 0
+        self.hits = self.misses = 0
+
+    def get(self, sha):
+        with self._lock:
+            data = self._blobs.pop(sha, None)
+            if data is None:
+                self.misses += 1
+                return None
+            self._blobs[sha] = data
+            self.hits += 1
+            return data
+
+    def set(self, sha, data):
+        if len(data) > self.max_size:
+            return
+        with self._lock:
+            if sha in self._blobs:
+                return
+            self._blobs[sha] = data
+            self.size += len(data)
+            while self.size > self.max_size:
+                self.size -= len(self._blobs.popitem(last=False)[1])
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'entries': len(self._blobs), 'size': self.size,
+                    'max_size': self.max_size}
+
+
+class CommitQueue(object):
+    """Saves waiting to be committed by a background thread, so requests
+    don't wait for git. The saves that arrive within ``window`` seconds
+    of the first pending one are committed together, one commit per
+    author (more only when authors take turns editing the same page).
+    Whatever is pending is committed when the process exits. Failed
+    commits are logged to ``logger`` and their saves queued again, up to
+    ``attempts`` times"""
+
+    def __init__(self, manager, window=DEFAULT_COMMIT_WINDOW, logger=None,
+                 attempts=COMMIT_ATTEMPTS):
+        self.manager = manager
+        self.window = window
+        self.logger = logger
+        self.attempts = attempts
+        self._cond = threading.Condition()
+        self._commit_lock = threading.Lock()
+        self._pending = []          # (author, path, data, message, tries)
+        self._thread = None
+        self._pid = None
+        self.saves = self.commits = self.errors = self.dropped = 0
+        self.last_error = None
+        atexit.register(self.flush)
+
+    def put(self, path, data, author=None, message=u''):
+        with self._cond:
+            if self._pid != os.getpid():
+                # saves inherited through a fork are the parent's
+                self._pending = []
+                self._thread = None
+                self._pid = os.getpid()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._pending.append((author, path, data, message, 0))
+            self.saves += 1
+            self._cond.notify()
+
+    def depth(self):
+        """Number of saves waiting to be committed"""
+        with self._cond:
+            return len(self._pending)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+            # let the rest of the burst arrive
+            time.sleep(self.window)
+            self.flush()
+
+    def flush(self):
+        """Commit every pending save now"""
+        with self._commit_lock:
+            with self._cond:
+                batch, self._pending = self._pending, []
+            # (key, author, paths, saves). A save joins the last commit
+            # of its author unless a later one, by somebody else, has
+            # the same page: the newest version must be committed last
+            groups = []
+            for author, path, data, message, tries in batch:
+                key = (author.name, author.email) if author else None
+                group = None
+                for candidate in reversed(groups):
+                    if candidate[0] == key:
+                        group = candidate
+                        break
+                    if path in candidate[2]:
+                        break
+                if group is None:
+                    group = (key, author, set(), [])
+                    groups.append(group)
+                group[2].add(path)
+                group[3].append((author, path, data, message, tries))
+            failed = []
+            for i, (key, author, paths, saves) in enumerate(groups):
+                head = self.manager._head()
+                try:
+                    self.manager.commit_saves(
+                        [save[1:4] for save in saves], author)
+                    self.commits += 1
+                except Exception as e:
+                    self.errors += 1
+                    self.last_error = u'%s: %s' % (type(e).__name__, e)
+                    if self.manager._head() != head:
+                        # HEAD moved: the commit is there, what failed
+                        # came after (e.g. the reflog). Don't repeat it
+                        self.commits += 1
+                        self._log('git commit of %s made, but git failed '
+                                  'after it' % ', '.join(sorted(paths)))
+                        continue
+                    # a page saved again later gets its newer version
+                    # from that commit, never this one
+                    later = set().union(*[g[2] for g in groups[i + 1:]])
+                    failed.extend(save for save in saves
+                                  if save[1] not in later)
+                    self._log('git commit of %s failed'
+                              % ', '.join(sorted(paths)))
+            self._requeue(failed)
+
+    def _log(self, message):
+        if self.logger is not None:
+            self.logger.exception(message)
+
+    def _requeue(self, saves):
+        retry = []
+        for author, path, data, message, tries in saves:
+            if tries + 1 < self.attempts:
+                retry.append((author, path, data, message, tries + 1))
+                continue
+            self.dropped += 1
+            if self.logger is not None:
+                self.logger.error('git commit of %s failed %d times, the '
+                                  'save is dropped' % (path, self.attempts))
+        if retry:
+            with self._cond:
+                self._pending[:0] = retry
+                self._cond.notify()
+
+    def stats(self):
+        return {'depth': self.depth(),
+                'saves': self.saves,
+                'commits': self.commits,
+                'errors': self.errors,
+                'dropped': self.dropped,
+                'last_error': self.last_error}
+
+
 class GitManager(object):
-    def __init__(self, content_dir):
+    def __init__(self, content_dir, blob_cache_size=DEFAULT_BLOB_CACHE_SIZE):
         self.content_dir = content_dir
+        # path -> (short sha, timestamp, author, previous short sha) of
+        # the last commits that touched it, as of the commit _revs_head
+        self._revs = {}
+        self._revs_head = None
+        self._revs_lock = threading.Lock()
+        # path -> {'head', 'entries', 'complete', 'max_changes'}: the
+        # newest entries of its history as of the commit 'head'
+        self._histories = collections.OrderedDict()
+        self._histories_lock = threading.Lock()
         if os.path.isdir(os.path.join(content_dir, '.git')):
             self.repository = Repo(content_dir, odbt=GitDB)
         else:
@@ -50,90 +430,269 @@ class GitManager(object):
                 os.makedirs(content_dir)
             os.chdir(content_dir)
             self.repository = Repo.init()
+        self._cat_file = CatFile(self.repository.working_dir)
+        self._cat_file_check = CatFile(self.repository.working_dir, check=True)
+        self.blobs = BlobCache(blob_cache_size)
+        self.queue = None
 
     def _get_blob_path(self, path):
         # remove "content/"
         return path.split(self.content_dir + os.path.sep)[1]
 
-    def _create_blob_for(self, path):
+    def _create_blob(self, path, data):
         repo = self.repository
-        page_abspath = os.path.join(os.path.split(self.repository.working_dir)[0], path)
-        data = open(page_abspath, 'r').read()
         istream = IStream('blob', len(data), StringIO(data))
         repo.odb.store(istream)
         blob_path = self._get_blob_path(path)
         blob = Blob(repo, istream.binsha, 0100644, blob_path)
         return blob
 
+    def read(self, path):
+        page_abspath = os.path.join(os.path.split(self.repository.working_dir)[0], path)
+        return open(page_abspath, 'r').read()
+
+    def author(self, user):
+        """The git Actor of a wiki user, None for the configured one"""
+        if user and user.is_authenticated():
+            return Actor(user.data.get('full_name', user.name),
+                         user.data.get('email', ''))
+        return None
+
     def commit(self, page, user=None, message=u''):
+        return self.commit_saves([(page.path, self.read(page.path), message)],
+                                 self.author(user))
+
+    def commit_saves(self, saves, author=None):
+        """Commit ``saves``, a list of ``(path, data, message)``, in a
+        single commit. Its message has the message of each save"""
         index = self.repository.index
-        blob = self._create_blob_for(page.path)
-        if os.path.isfile(blob.abspath):
-            index.add([blob.path])
+        entries = collections.OrderedDict()
+        messages = []
+        for path, data, message in saves:
+            blob = self._create_blob(path, data)
+            entries[blob.path] = IndexEntry.from_blob(blob)
+            if isinstance(message, str):
+                message = message.decode('utf-8')
+            messages.append((blob.path, message))
+        index.add(entries.values())
+        if len(messages) == 1:
+            message = messages[0][1]
         else:
-            index.add([IndexEntry.from_blob(blob)])
-        if user and user.is_authenticated():
-            os.environ['GIT_AUTHOR_NAME'] = user.data.get('full_name', user.name).encode('utf-8')
-            os.environ['GIT_AUTHOR_EMAIL'] = user.data.get('email', '').encode('utf-8')
-        return index.commit(message)
+            message = u'Update %s\n\n%s' % (
+                u', '.join(entries.keys()),
+                u'\n'.join(u'%s: %s' % item for item in messages if item[1]))
+        commit = index.commit(message.encode('utf-8'), author=author)
+        self._remember_rev(commit, entries.keys())
+        return commit
+
+    def _head(self):
+        """sha of HEAD, read from the refs (no git process)"""
+        try:
+            return self.repository.head.commit.hexsha
+        except ValueError:
+            return None         # no commits yet
+
+    def _remember_rev(self, commit, paths):
+        """Record ``commit`` as the last one of ``paths``, if the cache
+        was up to date with its parent"""
+        parents = [parent.hexsha for parent in commit.parents]
+        with self._revs_lock:
+            if self._revs_head != (parents[0] if parents else None):
+                return          # stale anyway: rebuilt on next read
+            revs = dict(self._revs)
+            for path in paths:
+                previous = revs.get(path)
+                revs[path] = (commit.hexsha[:7], commit.authored_date,
+                              commit.author.name,
+                              previous[0] if previous else '')
+            self._revs, self._revs_head = revs, commit.hexsha
+
+    def _load_revs(self, head):
+        """Rebuild the cache with a single pass over the history"""
+        # quotepath off: non ascii paths are listed as they are, not
+        # quoted and escaped
+        output = self.repository.git.execute(
+            ['git', '-c', 'core.quotepath=off', 'log',
+             '--format=%x01%h%x00%at%x00%an', '--name-only', '--no-renames'])
+        revs = {}
+        commit = None
+        for line in output.decode('utf-8').split('\n'):
+            if line.startswith('\x01'):
+                commit = line[1:].split('\x00')
+            elif line and commit:
+                previous = revs.get(line)
+                if previous is None:
+                    revs[line] = (commit[0], int(commit[1]), commit[2], '')
+                elif not previous[3]:
+                    revs[line] = previous[:3] + (commit[0],)
+        with self._revs_lock:
+            self._revs, self._revs_head = revs, head
+
+    def revision(self, path):
+        """(short sha, timestamp, author, previous short sha) of the last
+        commit of ``path``, or None if it was never committed"""
+        head = self._head()
+        if head is None:
+            return None
+        if head != self._revs_head:
+            # moved outside the app: a pull, a commit by hand...
+            self._load_revs(head)
+        return self._revs.get(path)
 
     def last_rev(self, page):
-        path = self._get_blob_path(page.path)
-        logs = self.repository.git.log('--format=%an %ad|%h', '--date=relative',
-                                      path).split('\n')
-
-        msg, version = logs[0].decode('utf-8').split('|')
-
-        if len(logs) > 1:
-            _, version_old = logs[1].decode('utf-8').split('|')
-        else: # in case of only one commit
-            _, version_old = '', ''
-
+        rev = self.revision(self._get_blob_path(page.path))
+        if rev is None:
+            return
+        version, timestamp, author, version_old = rev
         url = url_for('gitplugin.diff', url=page.url, new=version, old=version_old)
-        page.footer = u'<a href="%s">Last edited</a> by %s' % (url, msg)
-
-    def page_history(self, page):
-        path = self._get_blob_path(page.path)
-        data = [("commit", "%h"),
-                ("author", "%an"),
-                ("date", "%ad"),
-                ("date_relative", "%ar"),
-                ("message", "%s")]
-        format = "{%s}" % ','.join([""" \"%s\": \"%s\" """ % item for item in data])
-        output = self.repository.git.log('--format=%s' % format,
-                                         '-z',
-                                         '--shortstat', path)
-        output = output.replace('\x00', '').split('\n')
+        date = datetime.utcfromtimestamp(timestamp)
+        page.footer = (u'<a href="%s">Last edited</a> by %s '
+                       u'<time class="relative-date" datetime="%sZ">%s</time>'
+                       % (url, escape(author), date.isoformat(),
+                          relative_date(timestamp)))
+
+    def _log_history(self, path, *args):
+        """Parse the ``git log --shortstat`` of ``path``: a list of dicts,
+        newest first"""
+        output = self.repository.git.log('--format=%s' % HISTORY_FORMAT,
+                                         '--shortstat', *(args + ('--', path)))
         history = []
-        for line in output:
-            if line.startswith('{'):
-                history.append(json.loads(line))
-            else:
+        for line in output.decode('utf-8').split('\n'):
+            if line.startswith('\x01'):
+                sha, commit, author, date, timestamp, message = \
+                    line[1:].split('\x00', 5)
+                history.append({'sha': sha, 'commit': commit,
+                                'author': author, 'date': date,
+                                'timestamp': int(timestamp),
+                                'message': message,
+                                'insertion': 0, 'deletion': 0})
+            elif line.strip() and history:
                 insertion = re.match(r'.* (\d+) insertion', line)
                 deletion = re.match(r'.* (\d+) deletion', line)
                 history[-1]['insertion'] = int(insertion.group(1)) if insertion else 0
                 history[-1]['deletion'] = int(deletion.group(1)) if deletion else 0
         return history
 
+    def _store_history(self, path, head, entries, complete):
+        cached = {'head': head, 'entries': entries, 'complete': complete,
+                  'max_changes': max([e['insertion'] + e['deletion']
+                                      for e in entries] or [0])}
+        with self._histories_lock:
+            self._histories.pop(path, None)
+            self._histories[path] = cached
+            while len(self._histories) > HISTORY_CACHE_SIZE:
+                self._histories.popitem(last=False)
+        return cached
+
+    def _cached_history(self, path, head):
+        """The cached history of ``path``, brought up to ``head``"""
+        with self._histories_lock:
+            cached = self._histories.get(path)
+        if cached is None:
+            return self._store_history(path, head, [], False)
+        if cached['head'] == head:
+            return cached
+        # only the commits newer than the cached ones are fetched
+        try:
+            newer = self._log_history(path, '%s..%s' % (cached['head'], head))
+        except GitCommandError:
+            # the cached head is gone (history rewritten)
+            return self._store_history(path, head, [], False)
+        return self._store_history(path, head, newer + cached['entries'],
+                                   cached['complete'])
+
+    def page_history(self, page, number=1, per_page=HISTORY_PER_PAGE):
+        """Return the ``number`` page of the history of ``page``, whether
+        there are older entries, and the biggest change known, to scale
+        the bars"""
+        path = self._get_blob_path(page.path)
+        head = self._head()
+        if head is None:
+            return [], False, 0
+        cached = self._cached_history(path, head)
+        start = (number - 1) * per_page
+        end = start + per_page
+        entries = cached['entries']
+        if len(entries) <= end and not cached['complete']:
+            # one more than needed tells if there are older entries
+            wanted = end + 1 - len(entries)
+            older = self._log_history(path, '--skip=%d' % len(entries),
+                                      '--max-count=%d' % wanted,
+                                      cached['head'])
+            cached = self._store_history(path, cached['head'],
+                                         entries + older,
+                                         len(older) < wanted)
+            entries = cached['entries']
+        history = [dict(entry, date_relative=relative_date(entry['timestamp']))
+                   for entry in entries[start:end]]
+        return history, len(entries) > end, cached['max_changes']
+
     def page_version(self, page, version):
         path = self._get_blob_path(page.path)
+        sha = self.blob_sha(version, path)
+        if sha == EMPTY_BLOB:
+            return ''
+        return self.blob_data(sha)
+
+    def blob_sha(self, version, path):
+        """sha of the blob of ``path`` at commit ``version``. The empty
+        blob if it wasn't there"""
+        if not version:
+            return EMPTY_BLOB
+        info = self._cat_file_check.query('%s:%s' % (version, path))
+        if info is None or info[1] != 'blob':
+            return EMPTY_BLOB
+        return info[0]
+
+    def blob_data(self, sha):
+        if sha == EMPTY_BLOB:
+            return ''
+        data = self.blobs.get(sha)
+        if data is None:
+            info = self._cat_file.query(sha)
+            if info is None or info[1] != 'blob':
+                raise BadObject(sha)
+            data = info[2]
+            self.blobs.set(sha, data)
+        return data
+
+    def previous_commit(self, version, path):
+        """The commit that changed ``path`` before ``version`` did, or
+        '' if ``version`` is its first one (or not a commit sha)"""
+        if not COMMIT_RE.match(version):
+            # it comes from the url: never let it be taken as an option
+            return ''
         try:
-            return self.repository.git.show('%s:%s' % (version, path))
+            commits = self.repository.git.log('-2', '--format=%H', version,
+                                              '--', path).split()
         except GitCommandError:
             return ''
+        return commits[1] if len(commits) > 1 else ''
 
     def page_diff(self, page, old=None, new=None):
+        """Return the blob shas of ``page`` at the commits ``old`` and
+        ``new``. By default ``new`` is the last commit of the page and
+        ``old`` the one before ``new``"""
         path = self._get_blob_path(page.path)
-        history = self.repository.git.log('--format=%h', path).split('\n')
-        if old is None:
-            try:
-                old = history[1]
-            except IndexError:
-                pass
         if new is None:
-            new = history[0]
-        page.new = self.page_version(page, new)
-        page.old = self.page_version(page, old)
+            rev = self.revision(path) or ('', 0, '', '')
+            new = rev[0]
+            if old is None:
+                old = rev[3]
+        elif old is None:
+            old = self.previous_commit(new, path)
+        return self.blob_sha(old, path), self.blob_sha(new, path)
+
+    def diff_html(self, old_blob, new_blob, mode):
+        """Html diff between two blobs, cached: blobs never change"""
+        key = 'git-diff:%s:%s:%s' % (old_blob, new_blob, mode)
+        html = cache.get(key)
+        if html is None:
+            old = self.blob_data(old_blob).decode('utf-8', 'replace')
+            new = self.blob_data(new_blob).decode('utf-8', 'replace')
+            html = DIFFS[mode](old, new)
+            cache.set(key, html, timeout=DIFF_CACHE_TIMEOUT)
+        return html
 
     def deleted(self):
         """return a list of deleted path"""
@@ -151,13 +710,34 @@ class GitManager(object):
 #===============================================================================
 
 def git_commit(page, **extra):
-    current_app.git.commit(page, extra['user'], extra['message'])
+    git = current_app.git
+    if git.queue is None:
+        git.commit(page, extra['user'], extra['message'])
+    else:
+        git.queue.put(page.path, git.read(page.path),
+                      git.author(extra['user']), extra['message'])
 
 
 def git_rev(page, **extra):
     current_app.git.last_rev(page)
 
 
+def git_display_etag(url, **extra):
+    # the footer changes when a (maybe queued) commit lands, not only
+    # when the page does
+    git = current_app.git
+    rev = git.revision(git._get_blob_path(extra['path']))
+    return rev[0] if rev else None
+
+
+def on_collect_stats(sender, **extra):
+    git = current_app.git
+    stats = {'git_blobs': git.blobs.stats()}
+    if git.queue is not None:
+        stats['git_commit_queue'] = git.queue.stats()
+    return stats
+
+
 def extra_actions(page, **extra):
     context = extra['extra_context']
     actions = context.get('extra_actions', [])
@@ -175,22 +755,47 @@ def version(url, version):
     content = current_app.git.page_version(page, version)
     if not content:
         abort(404)
-    page.delete_cache()
     page.load(content.decode('utf-8'))
-    page.render()
     form = current_app.EditorForm(obj=page)
     form.message.data = 'Restored version @%s' % version
     return render_template('page_version.html', page=page,
                            version=version, form=form)
 
 
+@gitplugin.route('/<path:url>/_diff/<new>..', defaults={'old': None})
 @gitplugin.route('/<path:url>/_diff/<new>..<old>', methods=['GET', 'POST'])
 def diff(url, new, old):
     page = current_app.wiki.get_or_404(url)
-    current_app.git.page_diff(page, old, new)
+    old_blob, new_blob = current_app.git.page_diff(page, old, new)
     return render_template('diff.html', page=page,
                            new_commit=new,
-                           old_commit=old)
+                           old_commit=old,
+                           old_blob=old_blob,
+                           new_blob=new_blob,
+                           modes=DIFFS.keys())
+
+
+@gitplugin.route('/_diff/<old_blob>..<new_blob>/<mode>')
+def blob_diff(old_blob, new_blob, mode):
+    """The diff between two blobs, an html fragment that never changes"""
+    if mode not in DIFFS or not all(re.match('^[0-9a-f]{40}$', sha)
+                                    for sha in (old_blob, new_blob)):
+        abort(404)
+    response = current_app.response_class(mimetype='text/html')
+    response.set_etag('%s..%s/%s' % (old_blob, new_blob, mode))
+    # shared caches may only keep the diffs of a public wiki
+    public = current_app.config.get('PERMISSIONS', 'public') == 'public'
+    response.headers['Cache-Control'] = '%s, max-age=%d, immutable' % (
+        'public' if public else 'private', DIFF_CACHE_TIMEOUT)
+    if request.if_none_match.contains(response.get_etag()[0]):
+        response.status_code = 304
+        return response
+    try:
+        response.data = current_app.git.diff_html(old_blob, new_blob,
+                                                  mode).encode('utf-8')
+    except (BadObject, ValueError):
+        abort(404)
+    return response
 
 
 @gitplugin.route('/<path:url>/_history', methods=['GET', 'POST'])
@@ -200,10 +805,19 @@ def history(url):
         new, old = request.form.getlist('commit')
         return redirect(url_for('gitplugin.diff',
                                 url=page.url, new=new, old=old))
-    history = current_app.git.page_history(page)
-    max_changes = max([(v['insertion'] + v['deletion']) for v in history])
+    try:
+        number = max(int(request.args.get('page', 1)), 1)
+    except ValueError:
+        number = 1
+    per_page = current_app.config.get('GIT_HISTORY_PER_PAGE',
+                                      HISTORY_PER_PAGE)
+    history, has_older, max_changes = current_app.git.page_history(
+        page, number, per_page)
+    if not history and number > 1:
+        abort(404)
     return render_template('history.html', page=page, history=history,
-                           max_changes=max_changes)
+                           max_changes=max_changes or 1,
+                           history_page=number, has_older=has_older)
 
 
 @gitplugin.route('/_admin/deleted/', methods=['GET', 'POST'])
@@ -225,8 +839,14 @@ def init(app):
     app.register_blueprint(gitplugin)
     app.signals.signal('page-saved').connect(git_commit)
     app.signals.signal('pre-display').connect(git_rev)
+    app.signals.signal('display-etag').connect(git_display_etag)
     app.signals.signal('pre-display').connect(extra_actions)
-    app.git = GitManager(app.config['CONTENT_DIR'])
+    app.signals.signal('collect-stats').connect(on_collect_stats)
+    app.git = GitManager(app.config['CONTENT_DIR'],
+        app.config.get('GIT_BLOB_CACHE_SIZE', DEFAULT_BLOB_CACHE_SIZE))
+    window = app.config.get('GIT_COMMIT_WINDOW', DEFAULT_COMMIT_WINDOW)
+    if window:
+        app.git.queue = CommitQueue(app.git, window, app.logger)
 
 
 #===============================================================================
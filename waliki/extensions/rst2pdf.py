@@ -13,6 +13,10 @@
 
 """Convert a waliki page to pdf
 
+If rst2pdf is importable, the pdf is made in-process from the page's
+cached doctree (see :meth:`waliki.markup.RestructuredText.doctree`), so
+the source isn't parsed again. Otherwise the ``rst2pdf`` script is run.
+
 """
 
 
@@ -27,6 +31,13 @@ import tempfile
 
 from flask import Blueprint, send_file, current_app, url_for
 
+from waliki.markup import RestructuredText
+
+try:
+    from rst2pdf.createpdf import RstToPdf
+except ImportError:
+    RstToPdf = None
+
 
 #===============================================================================
 # BLUEPRINT
@@ -63,20 +74,31 @@ def init(app):
 # ROUTES
 #===============================================================================
 
-@pdf.route('/<path:url>/_pdf')
-def get_as_pdf(url):
-    page = current_app.wiki.get_or_404(url)
-    with tempfile.NamedTemporaryFile(suffix='.pdf') as output:
-        outfile = output.name
+def run_rst2pdf(path, outfile):
     virtualenv_rst2pdf = os.path.join(os.path.dirname(sys.executable),
                                       'rst2pdf')
     if os.path.isfile(virtualenv_rst2pdf):
         rst2pdf = virtualenv_rst2pdf
     else:
         rst2pdf = 'rst2pdf'
-    cmd = [rst2pdf, page.path, "-o", outfile]
+    cmd = [rst2pdf, path, "-o", outfile]
+    subprocess.call(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+@pdf.route('/<path:url>/_pdf')
+def get_as_pdf(url):
+    page = current_app.wiki.get_or_404(url)
+    if not isinstance(page.content, RestructuredText):
+        return ("Fail to generate output.\n\n"
+                "Only reStructuredText pages can be converted to pdf")
+    with tempfile.NamedTemporaryFile(suffix='.pdf') as output:
+        outfile = output.name
     try:
-        subprocess.call(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if RstToPdf is not None:
+            RstToPdf().createPdf(doctree=page.content.doctree(),
+                                 output=outfile)
+        else:
+            run_rst2pdf(page.path, outfile)
     except Exception as e:
         return "Fail to generate output.\n\n{0}".format(e)
     filename = page.title.replace('/', '-').replace('..', '-')  # securitize
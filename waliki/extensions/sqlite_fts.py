@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013-2014, Martín Gaitán
+# Copyright (c) 2012-2013, Alexander Jung-Loddenkemper
+# This file is part of Waliki (http://waliki.nqnwebs.com/)
+# License: BSD (https://github.com/mgaitan/waliki/blob/master/LICENSE)
+
+
+#===============================================================================
+# DOCS
+#===============================================================================
+
+"""Full text search backed by a SQLite FTS5 table
+
+Replaces the in-process search index. The database lives in ``DATA_DIR``
+so every worker shares it.
+
+Optional config:
+
+    ``FTS_DATABASE`` path of the sqlite file
+    (default: ``DATA_DIR/search.sqlite``)
+
+"""
+
+#===============================================================================
+# IMPORTS
+#===============================================================================
+
+import os
+import sqlite3
+import threading
+
+from flask import current_app
+from flask.ext.script import Command
+from jinja2 import escape, Markup
+
+from waliki.catalog import checksum, meta_value
+from waliki.search import Hit, parse_query
+
+
+#===============================================================================
+# CONSTANTS
+#===============================================================================
+
+DATABASE_FILENAME = "search.sqlite"
+
+SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS pages USING fts5(
+    url UNINDEXED, hash UNINDEXED, title, tags, body,
+    tokenize='unicode61'
+)
+"""
+
+# bm25() weights for url, hash, title, tags and body
+RANK = "bm25(pages, 0.0, 0.0, 10.0, 5.0, 1.0)"
+
+# snippet markers, escaped before turning them into html
+START_MARK, END_MARK = u'\x02', u'\x03'
+
+
+#===============================================================================
+# HELPERS
+#===============================================================================
+
+def fts_query(query):
+    """Translate a waliki query into a FTS5 MATCH expression.
+
+    Every token is quoted, so nothing the user writes is interpreted as
+    FTS5 syntax.
+
+    """
+    parts = []
+    for kind, value in parse_query(query):
+        if kind == 'prefix':
+            parts.append(u'"%s"*' % value)
+        elif kind == 'phrase':
+            parts.append(u'"%s"' % u' '.join(value))
+        else:
+            parts.append(u'"%s"' % value)
+    return u' '.join(parts)
+
+
+class FtsIndex(object):
+    """Pages of a :class:`waliki.wiki.Wiki` in a FTS5 table"""
+
+    def __init__(self, wiki, path):
+        self.wiki = wiki
+        self.path = path
+        self._local = threading.local()
+
+    @property
+    def db(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def create(self):
+        try:
+            with self.db:
+                self.db.execute(SCHEMA)
+        except sqlite3.OperationalError as err:
+            raise RuntimeError("Your sqlite build has no FTS5 support: %s" % err)
+
+    def _row(self, url):
+        try:
+            with open(self.wiki.path(url), 'rU') as f:
+                raw = f.read().decode('utf-8')
+        except IOError:
+            return None
+        meta, body = self.wiki.markup.read_meta(raw)
+        return (url, checksum(raw), meta_value(meta, 'title', default=url),
+                meta_value(meta, 'tags', sep=u', '), body)
+
+    def _replace(self, url):
+        self.db.execute('DELETE FROM pages WHERE url = ?', (url,))
+        row = self._row(url)
+        if row is not None:
+            self.db.execute('INSERT INTO pages (url, hash, title, tags, body) '
+                            'VALUES (?, ?, ?, ?, ?)', row)
+
+    def update(self, url):
+        with self.db:
+            self._replace(url)
+
+    def remove(self, url):
+        with self.db:
+            self.db.execute('DELETE FROM pages WHERE url = ?', (url,))
+
+    def sync(self):
+        """Update the rows whose hash differs from the catalog's"""
+        known = dict(self.db.execute('SELECT url, hash FROM pages'))
+        entries = self.wiki.catalog.entries()
+        with self.db:
+            for entry in entries:
+                if known.pop(entry.url, None) != entry.hash:
+                    self._replace(entry.url)
+            for url in known:
+                self.db.execute('DELETE FROM pages WHERE url = ?', (url,))
+
+    def rebuild(self):
+        """Reindex every page inside a single transaction.
+        Return the number of pages indexed"""
+        rows = (self._row(entry.url) for entry in self.wiki.catalog.entries())
+        rows = [row for row in rows if row is not None]
+        with self.db:
+            self.db.execute('DELETE FROM pages')
+            self.db.executemany('INSERT INTO pages (url, hash, title, tags, '
+                                'body) VALUES (?, ?, ?, ?, ?)', rows)
+            self.db.execute("INSERT INTO pages (pages) VALUES ('optimize')")
+        return len(rows)
+
+    def search(self, term, page=1, per_page=20):
+        """Same interface than :meth:`waliki.wiki.Wiki.search`"""
+        match = fts_query(term)
+        if not match:
+            return [], 0
+        total = self.db.execute('SELECT count(*) FROM pages '
+                                'WHERE pages MATCH ?', (match,)).fetchone()[0]
+        offset = (max(page, 1) - 1) * per_page
+        rows = self.db.execute(
+            'SELECT url, title, %s, snippet(pages, 4, ?, ?, ?, 40) '
+            'FROM pages WHERE pages MATCH ? ORDER BY %s LIMIT ? OFFSET ?'
+            % (RANK, RANK),
+            (START_MARK, END_MARK, u'…', match, per_page, offset))
+        hits = []
+        for url, title, rank, snippet in rows:
+            snippet = (unicode(escape(snippet))
+                       .replace(START_MARK, u'<strong>')
+                       .replace(END_MARK, u'</strong>'))
+            # bm25() is negative: the lower, the better
+            hits.append(Hit(url, title, -rank, Markup(snippet)))
+        return hits, total
+
+    # signal receivers
+
+    def on_page_saved(self, page, **extra):
+        self.update(page.url)
+
+    def on_page_moved(self, page, **extra):
+        with self.db:
+            self.db.execute('DELETE FROM pages WHERE url = ?', (page.url,))
+            self._replace(extra['newurl'])
+
+    def on_page_deleted(self, page, **extra):
+        self.remove(page.url)
+
+
+#===============================================================================
+# COMMANDS
+#===============================================================================
+
+class CmdFtsRebuild(Command):
+    """Rebuild the full text search table from all the pages"""
+
+    def run(self):
+        count = current_app.fts.rebuild()
+        print("%d pages indexed" % count)
+
+
+#===============================================================================
+# INITIALIZER
+#===============================================================================
+
+REQUIREMENTS = []
+
+
+def init(app):
+    path = app.config.get('FTS_DATABASE',
+                          os.path.join(app.config['DATA_DIR'], DATABASE_FILENAME))
+    app.fts = FtsIndex(app.wiki, path)
+    app.fts.create()
+    app.fts.sync()
+
+    app.signals.signal('page-saved').connect(app.fts.on_page_saved)
+    app.signals.signal('page-moved').connect(app.fts.on_page_moved)
+    app.signals.signal('page-deleted').connect(app.fts.on_page_deleted)
+
+    app.manager.add_command("fts_rebuild", CmdFtsRebuild())
+
+    # replace the in-process index
+    app.signals.signal('page-saved').disconnect(app.wiki.search_index.on_page_saved)
+    app.signals.signal('page-moved').disconnect(app.wiki.search_index.on_page_moved)
+    app.signals.signal('page-deleted').disconnect(app.wiki.search_index.on_page_deleted)
+    app.wiki.search = app.fts.search
+
+
+#===============================================================================
+# MAIN
+#===============================================================================
+
+if __name__ == "__main__":
+    print(__doc__)
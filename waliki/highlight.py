@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013-2014, Martín Gaitán
+# Copyright (c) 2012-2013, Alexander Jung-Loddenkemper
+# This file is part of Waliki (http://waliki.nqnwebs.com/)
+# License: BSD (https://github.com/mgaitan/waliki/blob/master/LICENSE)
+
+#===============================================================================
+# DOCS
+#===============================================================================
+
+"""Syntax highlighting cache
+
+Pages are mostly code, and lexing it with Pygments is most of the render
+time. :func:`install` puts a cache in front of the two places that call
+Pygments: ``highlight()`` in Python-Markdown's codehilite extension and
+the lexer docutils uses for ``code`` directives and roles.
+
+Entries are keyed by lexer, options and code, so the same snippet in
+another page (or in the next edit of the same page) isn't lexed again.
+The cache is bounded by (approximate) size in memory and, optionally,
+persisted under ``CACHE_DIR`` so it survives restarts and it's shared by
+every worker.
+
+"""
+
+#===============================================================================
+# IMPORTS
+#===============================================================================
+
+import os
+import hashlib
+import threading
+import collections
+import cPickle as pickle
+
+try:
+    from pygments import highlight as _highlight
+except ImportError:
+    _highlight = None
+
+try:
+    from markdown.extensions import codehilite
+except ImportError:
+    codehilite = None
+
+try:
+    from docutils.utils import code_analyzer
+except ImportError:
+    code_analyzer = None
+
+
+#===============================================================================
+# CONSTANTS
+#===============================================================================
+
+DEFAULT_MAX_SIZE = 32 * 1024 * 1024
+
+# rough per entry overhead of keys, tuples and lists
+ENTRY_OVERHEAD = 200
+
+
+#===============================================================================
+# CACHE
+#===============================================================================
+
+class HighlightCache(object):
+    """LRU of highlighted code, bounded by size, with an optional
+    directory where entries are persisted"""
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, path=None):
+        self.max_size = max_size
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()    # key -> (value, size)
+        self.size = 0
+        self.hits = self.disk_hits = self.misses = 0
+
+    def _filename(self, key):
+        return os.path.join(self.path, key[:2], key + '.pickle')
+
+    def _read(self, key):
+        try:
+            with open(self._filename(key), 'rb') as f:
+                return pickle.load(f)
+        except Exception:
+            return None
+
+    def _write(self, key, value):
+        filename = self._filename(key)
+        folder = os.path.dirname(filename)
+        if not os.path.exists(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                pass            # made by another worker meanwhile
+        tmp = '%s.%s.%s.tmp' % (filename, os.getpid(),
+                                threading.current_thread().ident)
+        with open(tmp, 'wb') as f:
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, filename)
+
+    def _remember(self, key, value, size):
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size and self._entries:
+                self.size -= self._entries.popitem(last=False)[1][1]
+
+    def get(self, key, compute, sizeof):
+        """Return the value cached for ``key`` or the result of calling
+        ``compute()``, that is cached then. ``sizeof(value)`` estimates
+        the memory used by a value"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+                self.hits += 1
+                return entry[0]
+        value = None
+        if self.path:
+            value = self._read(key)
+        if value is not None:
+            with self._lock:
+                self.disk_hits += 1
+        else:
+            value = compute()
+            with self._lock:
+                self.misses += 1
+            if self.path:
+                self._write(key, value)
+        self._remember(key, value, sizeof(value))
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits,
+                    'disk_hits': self.disk_hits,
+                    'misses': self.misses,
+                    'entries': len(self._entries),
+                    'size': self.size,
+                    'max_size': self.max_size,
+                    'persistent': bool(self.path)}
+
+
+cache = HighlightCache()
+
+
+#===============================================================================
+# HIGHLIGHTERS
+#===============================================================================
+
+def make_key(*parts):
+    seed = repr(parts)
+    return hashlib.sha1(seed).hexdigest()
+
+
+def cached_highlight(code, lexer, formatter, outfile=None):
+    """Same as ``pygments.highlight``, cached"""
+    if outfile is not None:
+        return _highlight(code, lexer, formatter, outfile)
+    key = make_key('pygments', type(lexer).__name__,
+                   sorted(lexer.options.items()),
+                   type(formatter).__name__,
+                   sorted(formatter.options.items()),
+                   code)
+    return cache.get(key,
+                     lambda: _highlight(code, lexer, formatter),
+                     lambda html: len(html) + len(code) + ENTRY_OVERHEAD)
+
+
+def _tokens_size(tokens):
+    return sum(len(value) for classes, value in tokens) + \
+        ENTRY_OVERHEAD * (len(tokens) + 1)
+
+
+def cached_lexer_iter(self):
+    """Replacement of ``docutils.utils.code_analyzer.Lexer.__iter__``:
+    the classified tokens of the code, cached"""
+    if self.lexer is None:
+        return _lexer_iter(self)
+    key = make_key('docutils', self.language, self.tokennames, self.code)
+    tokens = cache.get(key, lambda: list(_lexer_iter(self)), _tokens_size)
+    return iter(tokens)
+
+
+_lexer_iter = code_analyzer.Lexer.__iter__ if code_analyzer else None
+
+
+def install(config):
+    """Set up the cache from the app config and put it in front of
+    Pygments"""
+    cache.max_size = config.get('HIGHLIGHT_CACHE_SIZE', DEFAULT_MAX_SIZE)
+    if config.get('HIGHLIGHT_CACHE_PERSIST') and config.get('CACHE_DIR'):
+        cache.path = os.path.join(config['CACHE_DIR'], 'highlight')
+    cache.clear()
+    if not cache.max_size:
+        return
+    if codehilite is not None and getattr(codehilite, 'pygments', False):
+        codehilite.highlight = cached_highlight
+    if code_analyzer is not None and code_analyzer.with_pygments:
+        code_analyzer.Lexer.__iter__ = cached_lexer_iter
+
+
+#===============================================================================
+# SIGNAL RECEIVERS
+#===============================================================================
+
+def on_collect_stats(sender, **extra):
+    return {'highlight': cache.stats()}
+
+
+#===============================================================================
+# MAIN
+#===============================================================================
+
+if __name__ == "__main__":
+    print(__doc__)
@@ -19,15 +19,48 @@
 # IMPORTS
 #===============================================================================
 
+import os
 import re
+import copy
+import random
+import collections
+import hashlib
+import threading
+import cPickle as pickle
+import docutils
 import docutils.core
 import docutils.io
+import docutils.nodes
+import docutils.utils
+import docutils.transforms
+import docutils.parsers.rst
+import docutils.readers.doctree
+import docutils.readers.standalone
+import docutils.writers.null
 
 import markdown
 import textwrap
 from rst2html5 import HTML5Writer
 
+try:
+    import mistune
+except ImportError:
+    mistune = None
+
+try:
+    import markdown2
+except ImportError:
+    markdown2 = None
+
+try:
+    import pygments
+    from pygments.lexers import get_lexer_by_name, guess_lexer, TextLexer
+    from pygments.formatters import HtmlFormatter
+except ImportError:
+    pygments = HtmlFormatter = None
+
 import wiki
+import highlight
 
 
 #===============================================================================
@@ -41,6 +74,9 @@ class Markup(object):
     EXTENSION = '.txt'
     HOWTO = """ """
 
+    # a renderpool.RenderPool, if renders run out of process
+    pool = None
+
     def __init__(self, raw_content):
         self.raw_content = raw_content
 
@@ -48,6 +84,48 @@ class Markup(object):
     def render_meta(cls, key, value):
         return cls.META_LINE % (key, value)
 
+    @classmethod
+    def read_meta(cls, raw_content):
+        """
+        return (meta, body) reading only the header block, up to the
+        first blank line. It doesn't touch the markup engine, so it's
+        much cheaper than :meth:`process`
+        """
+        try:
+            meta_lines, body = raw_content.split('\n\n', 1)
+        except ValueError:
+            meta_lines, body = raw_content, u''
+        return cls._parse_meta(meta_lines.split('\n')), body
+
+    @classmethod
+    def _parse_meta(cls, lines):
+        """return a dictionary of lists from the header lines"""
+        raise NotImplementedError("override in a subclass")
+
+    @classmethod
+    def configure(cls, config):
+        """
+        set up the markup from the app config. Called once at startup
+        """
+        pass
+
+    def cache_key(self):
+        """
+        return a key that identifies the rendered output: a hash of the
+        source, the markup and the renderer settings
+        """
+        seed = u'%s\n%s\n%s' % (self.NAME, self.renderer_settings(),
+                                 self.raw_content)
+        return 'render:%s' % hashlib.sha1(seed.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def renderer_settings(cls):
+        """
+        return a string with anything that, besides the source,
+        changes the rendered output (versions, extensions, settings...)
+        """
+        return ''
+
     def process(self):
         """
         return (html, body, meta) where HTML is the rendered output
@@ -56,11 +134,165 @@ class Markup(object):
         """
         raise NotImplementedError("override in a subclass")
 
+    def render(self):
+        """
+        return the rendered html, made by a worker of the render pool if
+        there's one. Raise :class:`renderpool.RenderError` if the worker
+        failed, timed out or grew too much
+        """
+        if self.pool is not None:
+            return self.pool.run(render_html, type(self), self.raw_content)
+        return self.process()[0]
+
+    def blocks(self):
+        """
+        return a list of ``(block id, html)`` that, joined, make the
+        rendered output. Ids only change when their html does. Markups
+        that can't render a document in parts return a single block
+        """
+        key = self.cache_key().split(':', 1)[1]
+        return [(key, self.render())]
+
     @classmethod
     def howto(cls):
         return cls(textwrap.dedent(cls.HOWTO)).process()[0]
 
 
+#===============================================================================
+# MARKDOWN ENGINES
+#===============================================================================
+
+class MarkdownEngine(object):
+    """
+    A markdown implementation. An instance is used by a single thread,
+    for many documents.
+
+    Every engine renders the header out (if ``meta`` is in the extensions),
+    fenced code (``fenced_code``) and highlights code blocks with Pygments
+    the way codehilite does (``codehilite``)
+    """
+    NAME = None
+
+    def __init__(self, extensions):
+        self.extensions = extensions
+
+    @classmethod
+    def available(cls):
+        return True
+
+    @classmethod
+    def version(cls):
+        return ''
+
+    def convert(self, text):
+        if 'meta' in self.extensions:
+            meta, body = Markdown.read_meta(text)
+            if meta:
+                text = body
+        return self._convert(text)
+
+    def _convert(self, text):
+        raise NotImplementedError("override in a subclass")
+
+
+def markdown_engines():
+    """return a dict of the installed engines by name"""
+    return dict((engine.NAME, engine)
+                for engine in MarkdownEngine.__subclasses__()
+                if engine.available())
+
+
+def pygments_version():
+    """the version of pygments, None if it isn't installed"""
+    return pygments.__version__ if pygments is not None else None
+
+
+def codehilite(code, lang=None):
+    """highlight a code block as Python-Markdown's codehilite does"""
+    code = code.strip('\n')
+    try:
+        lexer = get_lexer_by_name(lang or '')
+    except ValueError:
+        try:
+            lexer = guess_lexer(code)
+        except ValueError:
+            lexer = TextLexer()
+    formatter = HtmlFormatter(linenos=False, cssclass='codehilite',
+                              style='default', noclasses=False)
+    return highlight.cached_highlight(code, lexer, formatter)
+
+
+class PythonMarkdownEngine(MarkdownEngine):
+    NAME = 'python-markdown'
+
+    def __init__(self, extensions):
+        super(PythonMarkdownEngine, self).__init__(extensions)
+        self.md = markdown.Markdown(extensions=extensions)
+
+    @classmethod
+    def version(cls):
+        return markdown.version
+
+    def convert(self, text):
+        # the meta extension does the header
+        self.md.reset()
+        return self.md.convert(text)
+
+
+class MistuneEngine(MarkdownEngine):
+    """mistune always does fenced code (and tables)"""
+    NAME = 'mistune'
+
+    def __init__(self, extensions):
+        super(MistuneEngine, self).__init__(extensions)
+        if 'codehilite' in extensions and HtmlFormatter is not None:
+            renderer = CodehiliteRenderer()
+        else:
+            renderer = mistune.Renderer()
+        self.md = mistune.Markdown(renderer=renderer)
+
+    @classmethod
+    def available(cls):
+        return mistune is not None
+
+    @classmethod
+    def version(cls):
+        return mistune.__version__
+
+    def _convert(self, text):
+        return self.md(text)
+
+
+if mistune is not None:
+    class CodehiliteRenderer(mistune.Renderer):
+        def block_code(self, code, lang=None):
+            return codehilite(code, lang)
+
+
+class Markdown2Engine(MarkdownEngine):
+    """markdown2 highlights fenced code with a language by itself"""
+    NAME = 'markdown2'
+    EXTRAS = {'fenced_code': 'fenced-code-blocks',
+              'footnotes': 'footnotes',
+              'tables': 'tables'}
+
+    def __init__(self, extensions):
+        super(Markdown2Engine, self).__init__(extensions)
+        extras = [self.EXTRAS[e] for e in extensions if e in self.EXTRAS]
+        self.md = markdown2.Markdown(extras=extras)
+
+    @classmethod
+    def available(cls):
+        return markdown2 is not None
+
+    @classmethod
+    def version(cls):
+        return markdown2.__version__
+
+    def _convert(self, text):
+        return unicode(self.md.convert(text))
+
+
 #===============================================================================
 # MARKDOWN
 #===============================================================================
@@ -96,20 +328,240 @@ class Markdown(Markup):
         [markdown]: http://daringfireball.net/projects/markdown/
         """
 
+    EXTENSIONS = ['codehilite', 'fenced_code', 'meta']
+
+    # name of the MarkdownEngine that renders, see configure()
+    ENGINE = 'python-markdown'
+
+    # building an engine loads and sets up every extension,
+    # so each thread keeps its own and reuses it between documents
+    _local = threading.local()
+
+    @classmethod
+    def configure(cls, config):
+        cls.EXTENSIONS = list(config.get('MARKDOWN_EXTENSIONS',
+                                         cls.EXTENSIONS))
+        engine = config.get('MARKDOWN_ENGINE', cls.ENGINE)
+        if engine not in markdown_engines():
+            raise ValueError("Unknown or not installed markdown engine: %s"
+                             % engine)
+        cls.ENGINE = engine
+
+    @classmethod
+    def renderer_settings(cls):
+        engine = markdown_engines()[cls.ENGINE]
+        # highlighted code changes with pygments, too
+        return repr((cls.ENGINE, engine.version(), cls.EXTENSIONS,
+                     pygments_version()))
+
+    # html of top-level blocks, see blocks()
+    BLOCK_CACHE_SIZE = 2000
+    _block_cache = collections.OrderedDict()
+    _block_cache_lock = threading.Lock()
+
+    FENCE_RE = re.compile(r'^(~{3,}|`{3,})')
+    LIST_RE = re.compile(r'^[ ]{0,3}([*+-]|\d+\.)[ \t]+')
+    # an html block opens with a tag, or a comment (as '!--')
+    HTML_BLOCK_RE = re.compile(r'^<(\w+|!--)')
+    # reference links and abbreviations, defined anywhere in the document
+    REFERENCE_RE = re.compile(r'^[ ]{0,3}\[[^\]^][^\]]*\]:\s*\S')
+    ABBR_RE = re.compile(r'^[*]\[[^\]]*\][ ]?:\s*\S')
+
+    @classmethod
+    def engine(cls, extensions=None, name=None):
+        """return this thread's engine (by default, ENGINE) for the given
+        extensions (by default, EXTENSIONS)"""
+        if extensions is None:
+            extensions = cls.EXTENSIONS
+        if getattr(cls._local, 'extensions', None) != cls.EXTENSIONS:
+            # configuration changed, start over
+            cls._local.engines = {}
+            cls._local.extensions = list(cls.EXTENSIONS)
+        key = (name or cls.ENGINE, tuple(extensions))
+        engine = cls._local.engines.get(key)
+        if engine is None:
+            engine = markdown_engines()[key[0]](list(extensions))
+            cls._local.engines[key] = engine
+        return engine
+
     def process(self):
         # Processes Markdown text to HTML, returns original markdown text,
         # and adds meta
-        md = markdown.Markdown(['codehilite', 'fenced_code', 'meta'])
-        html = md.convert(self.raw_content)
-        meta_lines, body = self.raw_content.split('\n\n', 1)
-        meta = md.Meta
+        html = self.engine().convert(self.raw_content)
+        meta, body = self.read_meta(self.raw_content)
         return html, body, meta
 
+    @classmethod
+    def split_blocks(cls, text):
+        """
+        return ``(blocks, definitions)``: the top-level blocks of ``text``
+        and its reference link (and abbreviation) definitions.
+
+        Blocks are separated by blank lines, except where that would
+        change the output: fenced code, indented continuations, lists and
+        blockquotes (python-markdown merges them with the previous one)
+        and html blocks (comments too) aren't split.
+        """
+        blocks = []
+        definitions = []
+        current = []
+        fence = None
+        html_tag = None
+        blank = False
+        for line in text.split('\n'):
+            if fence:
+                current.append(line)
+                if line.rstrip() == fence:
+                    fence = None
+                continue
+            if not line.strip():
+                blank = bool(current)
+                if current:
+                    current.append(line)
+                continue
+            if blank and not html_tag and not cls._continues(current, line):
+                blocks.append(u'\n'.join(current).rstrip())
+                current = []
+            blank = False
+            if not current:
+                match = cls.HTML_BLOCK_RE.match(line)
+                html_tag = match.group(1) if match else None
+            current.append(line)
+            if html_tag == '!--':
+                if '-->' in line:
+                    html_tag = None
+            elif html_tag and (u'</%s>' % html_tag in line or
+                               line.rstrip().endswith('/>')):
+                html_tag = None
+            if (cls.REFERENCE_RE.match(line) or
+                    ('abbr' in cls.EXTENSIONS and cls.ABBR_RE.match(line))):
+                definitions.append(line)
+            match = cls.FENCE_RE.match(line)
+            if match:
+                fence = match.group(1)
+        if current:
+            blocks.append(u'\n'.join(current).rstrip())
+        return blocks, definitions
+
+    @classmethod
+    def _continues(cls, block, line):
+        """whether ``line``, after a blank line, belongs to ``block``"""
+        if line[0] in ' \t':
+            return True
+        first = block[0]
+        if cls.LIST_RE.match(line) and cls.LIST_RE.match(first):
+            return True
+        return line.startswith('>') and first.startswith('>')
+
+    def _incremental(self, body):
+        # footnotes and the table of contents are numbered and built
+        # from the whole document
+        if 'footnotes' in self.EXTENSIONS and '[^' in body:
+            return False
+        return not ('toc' in self.EXTENSIONS and '[TOC]' in body)
+
+    def blocks(self):
+        """
+        render the body block by block, reusing the html of the blocks
+        already rendered. Reference links are resolved document-wide
+        """
+        meta, body = self.read_meta(self.raw_content)
+        if not meta:
+            body = self.raw_content
+        if not self._incremental(body):
+            return super(Markdown, self).blocks()
+
+        blocks, definitions = self.split_blocks(body)
+        definitions = u'\n'.join(definitions)
+        seed = u'%s\n%s\n' % (self.renderer_settings(), definitions)
+        # the header is already out
+        extensions = [e for e in self.EXTENSIONS if e != 'meta']
+        cache = self._block_cache
+        keys = []
+        found = {}
+        missing = collections.OrderedDict()     # key -> source
+        for block in blocks:
+            key = hashlib.sha1((seed + block).encode('utf-8')).hexdigest()
+            keys.append(key)
+            with self._block_cache_lock:
+                html = cache.pop(key, None)
+                if html is not None:
+                    cache[key] = found[key] = html
+            if html is None:
+                missing[key] = u'%s\n\n%s' % (block, definitions)
+
+        # the new blocks are rendered in one go, by a single worker of
+        # the pool if there is one
+        rendered = []
+        if missing and self.pool is not None:
+            rendered = self.pool.run(render_markdown_blocks,
+                                     missing.values(), extensions)
+        elif missing:
+            rendered = render_markdown_blocks(missing.values(), extensions)
+        with self._block_cache_lock:
+            for key, html in zip(missing, rendered):
+                cache[key] = found[key] = html
+            while len(cache) > self.BLOCK_CACHE_SIZE:
+                cache.popitem(last=False)
+        return [(key, found[key]) for key in keys]
+
+    @classmethod
+    def _parse_meta(cls, lines):
+        """ Parse Meta-Data. Same rules than Python-Markdown's meta extension"""
+        META_RE = re.compile(r'^[ ]{0,3}(?P<key>[A-Za-z0-9_-]+):\s*(?P<value>.*)')
+        META_MORE_RE = re.compile(r'^[ ]{4,}(?P<value>.*)')
+        meta = {}
+        key = None
+        for line in lines:
+            if line.strip() == '':
+                break
+            m1 = META_RE.match(line)
+            if m1:
+                key = m1.group('key').lower().strip()
+                value = m1.group('value').strip()
+                try:
+                    meta[key].append(value)
+                except KeyError:
+                    meta[key] = [value]
+            else:
+                m2 = META_MORE_RE.match(line)
+                if m2 and key:
+                    meta[key].append(m2.group('value').strip())
+                else:
+                    break
+        return meta
+
 
 #===============================================================================
 # RESTRUCTURED TEXT
 #===============================================================================
 
+def wiki_link_resolver(node):
+    """
+    docutils resolver for references without a target: they become
+    links to wiki pages. Examples:
+
+      Something_ will link to '/something'
+      `something great`_  to '/something-great'
+    """
+    node['refuri'] = '/' + wiki.urlify(node['refname'], False)
+    del node['refname']
+    node.resolved = 1
+    return True
+
+# docutils tries resolvers by ascending priority and this one takes any
+# reference: resolvers of other components with a lower priority go first
+wiki_link_resolver.priority = 100
+
+
+class WikiReader(docutils.readers.standalone.Reader):
+    """standalone reader that resolves unknown references as wiki links,
+    in the same parse"""
+    unknown_reference_resolvers = (
+        (wiki_link_resolver,) +
+        docutils.readers.standalone.Reader.unknown_reference_resolvers)
+
+
 class RestructuredText(Markup):
     NAME = 'restructuredtext'
     META_LINE = '.. %s: %s\n'
@@ -150,62 +602,168 @@ class RestructuredText(Markup):
         .. _reStructuredText: http://docutils.sourceforge.net/rst.html
         """
 
+    SETTINGS = {'initial_header_level': 2,
+                'record_dependencies': True,
+                'stylesheet_path': None,
+                'link_stylesheet': True,
+                'syntax_highlight': 'short',
+                }
+
+    # building docutils settings means building its whole option parser,
+    # so they are made once (by overrides) and copied for each render.
+    # Parser and writer are reused by each thread.
+    _settings = {}
+    _settings_lock = threading.Lock()
+    _local = threading.local()
+
+    @classmethod
+    def renderer_settings(cls):
+        # code blocks are highlighted by pygments
+        return repr((docutils.__version__, pygments_version(),
+                     sorted(cls.SETTINGS.items())))
+
+    # parsed documents are pickled here (see configure), so html
+    # or pdf don't need to parse the source again
+    DOCTREE_DIR = None
+    DOCTREE_CACHE_MAX = 5000
+
+    @classmethod
+    def configure(cls, config):
+        if config.get('CACHE_DIR'):
+            cls.DOCTREE_DIR = os.path.join(config['CACHE_DIR'], 'doctrees')
+
     def process(self):
-        settings = {'initial_header_level': 2,
-                    'record_dependencies': True,
-                    'stylesheet_path': None,
-                    'link_stylesheet': True,
-                    'syntax_highlight': 'short',
-                    }
-
-        html = self._rst2html(self.raw_content,
-                              settings_overrides=settings)
-
-        # Convert unknow links to internal wiki links.
-        # Examples:
-        #   Something_ will link to '/something'
-        #  `something great`_  to '/something_great'
-        #  `another thing <thing>`_  '/thing'
-        refs = re.findall(r'Unknown target name: "(.*)"', html)
-        if refs:
-            content = self.raw_content + self.get_autolinks(refs)
-            html = self._rst2html(content, settings_overrides=settings)
-        meta_lines, body = self.raw_content.split('\n\n', 1)
-        meta = self._parse_meta(meta_lines.split('\n'))
+        settings = self.SETTINGS
+
+        # unknown links are turned into internal wiki links
+        # by the reader (see wiki_link_resolver)
+        if self.DOCTREE_DIR:
+            html = self.to_html()
+        else:
+            html = self._rst2html(self.raw_content,
+                                  settings_overrides=settings)
+        meta, body = self.read_meta(self.raw_content)
         return html, body, meta
 
-    def get_autolinks(self, refs):
-        autolinks = '\n'.join(['.. _%s: /%s' % (ref, wiki.urlify(ref, False))
-                               for ref in refs])
-        return '\n\n' + autolinks
-
-    def _rst2html(self, source, source_path=None,
-                  source_class=docutils.io.StringInput,
-                  destination_path=None, reader=None, reader_name='standalone',
-                  parser=None, parser_name='restructuredtext', writer=None,
-                  writer_name=None, settings=None, settings_spec=None,
-                  settings_overrides=None, config_section=None,
-                  enable_exit_status=None):
-
-        if not writer:
-            writer = HTML5Writer()
-
-        # Taken from Nikola
-        # http://bit.ly/14CmQyh
-        output, pub = docutils.core.publish_programmatically(
-            source=source, source_path=source_path, source_class=source_class,
-            destination_class=docutils.io.StringOutput,
-            destination=None, destination_path=destination_path,
-            reader=reader, reader_name=reader_name,
-            parser=parser, parser_name=parser_name,
-            writer=writer, writer_name=writer_name,
-            settings=settings, settings_spec=settings_spec,
-            settings_overrides=settings_overrides,
-            config_section=config_section,
-            enable_exit_status=enable_exit_status)
+    def doctree(self):
+        """return the parsed document, from the doctree cache if possible"""
+        document = pickle.loads(self._pickled_doctree())
+        document.settings = copy.copy(self._frozen_settings())
+        document.reporter = docutils.utils.new_reporter(
+            document.get('source', ''), document.settings)
+        document.transformer = docutils.transforms.Transformer(document)
+        return document
+
+    def to_html(self):
+        return self._write_doctree(self.doctree(), self._components()[1])
+
+    def _pickled_doctree(self):
+        path = None
+        if self.DOCTREE_DIR:
+            name = self.cache_key().split(':', 1)[1] + '.pickle'
+            path = os.path.join(self.DOCTREE_DIR, name)
+            try:
+                with open(path, 'rb') as f:
+                    return f.read()
+            except IOError:
+                pass
+
+        parser = self._components()[0]
+        pub = docutils.core.Publisher(
+            reader=WikiReader(parser=parser), parser=parser,
+            writer=docutils.writers.null.Writer(),
+            source_class=docutils.io.StringInput,
+            destination_class=docutils.io.NullOutput)
+        pub.settings = copy.copy(self._frozen_settings())
+        pub.set_source(self.raw_content)
+        pub.set_destination()
+        pub.publish()
+        document = pub.document
+        # what can't (or shouldn't) be pickled is rebuilt in doctree()
+        document.reporter = document.transformer = document.settings = None
+        data = pickle.dumps(document, pickle.HIGHEST_PROTOCOL)
+
+        if path:
+            if not os.path.exists(self.DOCTREE_DIR):
+                os.makedirs(self.DOCTREE_DIR)
+            tmp = '%s.%s.tmp' % (path, os.getpid())
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.rename(tmp, path)
+            if random.random() < 0.01:
+                self._prune_doctrees()
+        return data
+
+    @classmethod
+    def _prune_doctrees(cls):
+        """keep only the DOCTREE_CACHE_MAX most recently written doctrees"""
+        paths = [os.path.join(cls.DOCTREE_DIR, name)
+                 for name in os.listdir(cls.DOCTREE_DIR)]
+        if len(paths) <= cls.DOCTREE_CACHE_MAX:
+            return
+        paths.sort(key=lambda p: os.path.getmtime(p) if os.path.exists(p) else 0)
+        for path in paths[:-cls.DOCTREE_CACHE_MAX]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _write_doctree(self, document, writer):
+        """return the body written by ``writer`` from a parsed document"""
+        pub = docutils.core.Publisher(
+            reader=docutils.readers.doctree.Reader(parser_name='null'),
+            writer=writer, source=docutils.io.DocTreeInput(document),
+            destination_class=docutils.io.StringOutput)
+        pub.settings = copy.copy(self._frozen_settings())
+        pub.set_destination()
+        pub.publish()
         return pub.writer.parts['body']
 
-    def _parse_meta(self, lines):
+    def _rst2html(self, source, settings_overrides=None):
+        parser, writer = self._components()
+        pub = docutils.core.Publisher(
+            reader=WikiReader(parser=parser),
+            parser=parser, writer=writer,
+            source_class=docutils.io.StringInput,
+            destination_class=docutils.io.StringOutput)
+        # a copy, since docutils writes a few values (i.e. _source) in it
+        pub.settings = copy.copy(self._frozen_settings(settings_overrides))
+        pub.set_source(source)
+        pub.set_destination()
+        pub.publish()
+        return pub.writer.parts['body']
+
+    @classmethod
+    def _components(cls):
+        """return this thread's (parser, writer). They hold the state of
+        the document being processed, so they can't be shared"""
+        local = cls._local
+        if not hasattr(local, 'writer'):
+            local.parser = docutils.parsers.rst.Parser()
+            local.writer = HTML5Writer()
+        return local.parser, local.writer
+
+    @classmethod
+    def _frozen_settings(cls, overrides=None):
+        """return the settings for ``overrides``, building them (and the
+        docutils option parser) only the first time"""
+        overrides = cls.SETTINGS if overrides is None else overrides
+        key = tuple(sorted(overrides.items()))
+        settings = cls._settings.get(key)
+        if settings is None:
+            with cls._settings_lock:
+                settings = cls._settings.get(key)
+                if settings is None:
+                    parser = docutils.parsers.rst.Parser()
+                    pub = docutils.core.Publisher(
+                        reader=WikiReader(parser=parser),
+                        parser=parser, writer=HTML5Writer())
+                    settings = pub.get_settings(**overrides)
+                    cls._settings[key] = settings
+        return settings
+
+    @classmethod
+    def _parse_meta(cls, lines):
         """ Parse Meta-Data. Taken from Python-Markdown"""
         META_RE = re.compile(r'^\.\.\s(?P<key>.*?): (?P<value>.*)')
         meta = {}
@@ -224,6 +782,21 @@ class RestructuredText(Markup):
         return meta
 
 
+#===============================================================================
+# RENDER JOBS
+#===============================================================================
+
+# module level, so they can be sent to the workers of a render pool
+
+def render_html(markup, raw_content):
+    return markup(raw_content).process()[0]
+
+
+def render_markdown_blocks(sources, extensions):
+    engine = Markdown.engine(extensions)
+    return [engine.convert(source) for source in sources]
+
+
 #===============================================================================
 # MAIN
 #===============================================================================
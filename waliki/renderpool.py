@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013-2014, Martín Gaitán
+# Copyright (c) 2012-2013, Alexander Jung-Loddenkemper
+# This file is part of Waliki (http://waliki.nqnwebs.com/)
+# License: BSD (https://github.com/mgaitan/waliki/blob/master/LICENSE)
+
+#===============================================================================
+# DOCS
+#===============================================================================
+
+"""Out of process rendering
+
+A pathological document can keep docutils or Python-Markdown busy for
+minutes. With ``RENDER_WORKERS`` set, renders run in a pool of forked
+processes shared by every thread of the app: a job that takes more than
+``RENDER_TIMEOUT`` seconds, or makes its worker grow over
+``RENDER_MAX_RSS`` megabytes, gets the worker killed (and replaced) and a
+:class:`RenderError` raised instead.
+
+Workers are forked the first time they are needed, so they inherit the
+configured markup (and each forked server process gets its own).
+
+"""
+
+#===============================================================================
+# IMPORTS
+#===============================================================================
+
+import os
+import time
+import Queue
+import signal
+import threading
+import multiprocessing
+
+from jinja2 import escape
+
+
+#===============================================================================
+# CONSTANTS
+#===============================================================================
+
+DEFAULT_TIMEOUT = 10            # seconds
+DEFAULT_MAX_RSS = 256           # megabytes
+
+# how often a running job is checked
+POLL_INTERVAL = 0.05
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+#===============================================================================
+# ERRORS
+#===============================================================================
+
+class RenderError(Exception):
+    """A render failed, timed out or its worker used too much memory"""
+
+    def __init__(self, message):
+        super(RenderError, self).__init__(message)
+        self.message = message
+
+    @property
+    def html(self):
+        """an error fragment to show instead of the rendered page"""
+        return (u'<div class="alert alert-error render-error">'
+                u'This page could not be rendered: %s</div>'
+                % escape(self.message))
+
+
+#===============================================================================
+# WORKERS
+#===============================================================================
+
+def rss(pid):
+    """Return the resident set size of a process in bytes, or None if it
+    can't be known (no /proc)"""
+    try:
+        with open('/proc/%d/statm' % pid) as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (IOError, ValueError, IndexError):
+        return None
+
+
+def serve(conn, max_rss):
+    """Main loop of a worker: run ``(func, args)`` jobs until the pipe
+    is closed. The worker retires itself once it's grown over
+    ``max_rss``"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while True:
+        try:
+            func, args = conn.recv()
+        except (EOFError, IOError):
+            break
+        try:
+            result = ('ok', func(*args))
+        except Exception as e:
+            result = ('error', u'%s: %s' % (type(e).__name__, e))
+        conn.send(result)
+        size = rss(os.getpid())
+        if max_rss and size is not None and size > max_rss:
+            break
+    conn.close()
+
+
+class Worker(object):
+
+    def __init__(self, max_rss):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=serve,
+                                               args=(child_conn, max_rss))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+
+    @property
+    def alive(self):
+        return self.process.is_alive()
+
+    def rss(self):
+        return rss(self.process.pid)
+
+    def kill(self):
+        self.conn.close()
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(1)
+        if self.process.is_alive():
+            os.kill(self.process.pid, signal.SIGKILL)
+            self.process.join()
+
+
+class RenderPool(object):
+    """Pool of render worker processes"""
+
+    def __init__(self, size, timeout=DEFAULT_TIMEOUT, max_rss=DEFAULT_MAX_RSS):
+        self.size = size
+        self.timeout = timeout
+        self.max_rss = max_rss * 1024 * 1024 if max_rss else None
+        self._lock = threading.Lock()
+        self._pid = None
+        self._idle = None
+        self.jobs = self.errors = self.timeouts = self.crashes = 0
+        self.oversized = 0
+
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # workers inherited through a fork belong to the parent
+            self._idle = Queue.Queue()
+            for i in range(self.size):
+                self._idle.put(Worker(self.max_rss))
+            self._pid = os.getpid()
+
+    def _acquire(self):
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            worker = self._idle.get(timeout=self.timeout)
+        except Queue.Empty:
+            raise RenderError(u'every render worker is busy')
+        if not worker.alive:
+            # it retired itself, or was killed
+            worker.kill()
+            worker = Worker(self.max_rss)
+        return worker
+
+    def _release(self, worker, healthy=True):
+        if not healthy:
+            worker.kill()
+            worker = Worker(self.max_rss)
+        self._idle.put(worker)
+
+    def _wait(self, worker):
+        deadline = time.time() + self.timeout
+        while not worker.conn.poll(POLL_INTERVAL):
+            if time.time() > deadline:
+                self.timeouts += 1
+                raise RenderError(u'it took more than %s seconds'
+                                  % self.timeout)
+            size = worker.rss()
+            if self.max_rss and size is not None and size > self.max_rss:
+                self.oversized += 1
+                raise RenderError(u'it needed more than %d MB of memory'
+                                  % (self.max_rss // (1024 * 1024)))
+            if not worker.alive:
+                break
+        try:
+            return worker.conn.recv()
+        except (EOFError, IOError):
+            self.crashes += 1
+            raise RenderError(u'the render worker crashed')
+
+    def run(self, func, *args):
+        """Return ``func(*args)`` computed by a worker. ``func`` and
+        ``args`` must be picklable"""
+        worker = self._acquire()
+        self.jobs += 1
+        healthy = False
+        try:
+            worker.conn.send((func, args))
+            status, result = self._wait(worker)
+            healthy = True
+        finally:
+            self._release(worker, healthy)
+        if status == 'error':
+            self.errors += 1
+            raise RenderError(result)
+        return result
+
+    def stats(self):
+        return {'workers': self.size,
+                'idle': self._idle.qsize() if self._idle else 0,
+                'jobs': self.jobs,
+                'errors': self.errors,
+                'timeouts': self.timeouts,
+                'crashes': self.crashes,
+                'oversized': self.oversized}
+
+    # signal receivers
+
+    def on_collect_stats(self, sender, **extra):
+        return {'render_pool': self.stats()}
+
+
+#===============================================================================
+# MAIN
+#===============================================================================
+
+if __name__ == "__main__":
+    print(__doc__)
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013-2014, Martín Gaitán
+# Copyright (c) 2012-2013, Alexander Jung-Loddenkemper
+# This file is part of Waliki (http://waliki.nqnwebs.com/)
+# License: BSD (https://github.com/mgaitan/waliki/blob/master/LICENSE)
+
+#===============================================================================
+# DOCS
+#===============================================================================
+
+"""Full page cache for anonymous readers
+
+Rendered pages, index and tags are cached with holes punched where they
+depend on who is reading: templates mark them with :func:`hole` (a
+fragment such as the user menu or the flash messages) and
+:func:`editable_begin` / :func:`editable_end` (something shown only to
+users that can edit). The cached body is the same for everybody, and
+:meth:`ResponseCache.fill` completes it for the current request.
+
+Markers carry a random nonce, stored with each entry, so markers that
+come from page content (a page can contain any html comment) are never
+taken as holes.
+
+Entries are stored with the etag they were made for, so an entry is only
+served while the page (or the catalog, for listings) is unchanged. Page
+saves, moves and deletes also drop the entries they affect.
+
+"""
+
+#===============================================================================
+# IMPORTS
+#===============================================================================
+
+import os
+import re
+
+from flask import g, current_app
+from jinja2 import Markup
+
+from tags import normalize
+
+
+#===============================================================================
+# CONSTANTS
+#===============================================================================
+
+# of the markers this process makes. Unguessable, as it is never sent
+NONCE = os.urandom(8).encode('hex')
+
+HOLE = u'<!--waliki-hole:%s:%s-->'
+HOLE_RE = r'<!--waliki-hole:%s:(\w+)-->'
+
+EDITABLE_BEGIN = u'<!--waliki-editable:%s-->'
+EDITABLE_END = u'<!--/waliki-editable:%s-->'
+EDITABLE_RE = r'<!--waliki-editable:%s-->(.*?)<!--/waliki-editable:%s-->'
+
+DEFAULT_TIMEOUT = 60 * 60 * 24
+
+
+#===============================================================================
+# TEMPLATE HELPERS
+#===============================================================================
+
+def filling():
+    """Whether the response being rendered goes to the cache"""
+    return getattr(g, 'filling_response_cache', False)
+
+
+def hole(name):
+    """A per user fragment: a placeholder if the response goes to the
+    cache, the fragment itself otherwise"""
+    if filling():
+        return Markup(HOLE % (NONCE, name))
+    return Markup(current_app.response_cache.fragment(name))
+
+
+def editable_begin():
+    return Markup(EDITABLE_BEGIN % NONCE) if filling() else u''
+
+
+def editable_end():
+    return Markup(EDITABLE_END % NONCE) if filling() else u''
+
+
+#===============================================================================
+# CACHE
+#===============================================================================
+
+class ResponseCache(object):
+    """Bodies of views, keyed by view and arguments.
+
+    ``fragments`` maps hole names to functions returning the html of the
+    fragment for the current request, and ``can_edit`` is a function
+    that tells if the current user sees the editable parts.
+
+    """
+
+    def __init__(self, cache, fragments, can_edit, timeout=DEFAULT_TIMEOUT):
+        self.cache = cache
+        self.fragments = fragments
+        self.can_edit = can_edit
+        self.timeout = timeout
+        self.hits = self.misses = 0
+
+    @staticmethod
+    def key(view, *args):
+        key = u'response:%s:%s' % (view, u'/'.join(args))
+        return key.encode('utf-8')
+
+    def fragment(self, name):
+        fragment = self.fragments.get(name)
+        return fragment() if fragment is not None else u''
+
+    def render(self, key, etag, render):
+        """Return the body of the view at ``key`` for the current request,
+        from the cache if it's there for ``etag``, or ``render()``
+        and cache it"""
+        entry = self.cache.get(key)
+        if entry is not None and len(entry) == 3 and entry[0] == etag:
+            self.hits += 1
+            return self.fill(entry[1], entry[2])
+        self.misses += 1
+        g.filling_response_cache = True
+        try:
+            body = render()
+        finally:
+            g.filling_response_cache = False
+        if not isinstance(body, basestring):
+            # a redirect, or so
+            return body
+        self.cache.set(key, (etag, body, NONCE), timeout=self.timeout)
+        return self.fill(body)
+
+    def fill(self, body, nonce=NONCE):
+        """Complete a cached body, made with the markers of ``nonce``,
+        for the current request"""
+        can_edit = self.can_edit()
+        editable_re = re.compile(EDITABLE_RE % (nonce, nonce), re.DOTALL)
+        body = editable_re.sub(lambda m: m.group(1) if can_edit else u'',
+                               body)
+        return re.sub(HOLE_RE % nonce, lambda m: self.fragment(m.group(1)),
+                      body)
+
+    def invalidate(self, *keys):
+        for key in keys:
+            self.cache.delete(key)
+
+    # signal receivers
+
+    def _invalidate_page(self, page, urls):
+        keys = [self.key('index'), self.key('tags')]
+        keys.extend(self.key('display', url) for url in urls)
+        tags = page.meta.get('tags', [])
+        for tag in u','.join(tags).split(u','):
+            if normalize(tag):
+                keys.append(self.key('tag', normalize(tag)))
+        self.invalidate(*keys)
+
+    def on_page_saved(self, page, **extra):
+        self._invalidate_page(page, [page.url])
+
+    def on_page_moved(self, page, **extra):
+        self._invalidate_page(page, [page.url, extra['newurl']])
+
+    def on_page_deleted(self, page, **extra):
+        self._invalidate_page(page, [page.url])
+
+    def on_collect_stats(self, sender, **extra):
+        return {'response_cache': {'hits': self.hits, 'misses': self.misses}}
+
+
+#===============================================================================
+# MAIN
+#===============================================================================
+
+if __name__ == "__main__":
+    print(__doc__)
@@ -0,0 +1,417 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013-2014, Martín Gaitán
+# Copyright (c) 2012-2013, Alexander Jung-Loddenkemper
+# This file is part of Waliki (http://waliki.nqnwebs.com/)
+# License: BSD (https://github.com/mgaitan/waliki/blob/master/LICENSE)
+
+#===============================================================================
+# DOCS
+#===============================================================================
+
+"""In-process full text search
+
+An inverted index (term -> page -> positions) ranked with BM25. Queries
+are a list of words that must all be present; ``word*`` matches by prefix
+and ``"some words"`` matches a phrase.
+
+The index follows the catalog: pages whose hash changed are reindexed
+before each query, so other workers' saves and external edits are picked
+up. It's pickled under ``CACHE_DIR`` so a restart only reindexes what
+changed meanwhile.
+
+"""
+
+#===============================================================================
+# IMPORTS
+#===============================================================================
+
+import os
+import re
+import math
+import time
+import atexit
+import bisect
+import threading
+import cPickle as pickle
+
+from jinja2 import Markup, escape
+
+from catalog import checksum, meta_value
+
+
+#===============================================================================
+# CONSTANTS
+#===============================================================================
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+QUERY_RE = re.compile(r'"([^"]*)"|(\S+)', re.UNICODE)
+
+# bump it when the pickled structure changes
+INDEX_VERSION = 1
+
+
+#===============================================================================
+# FUNCTIONS
+#===============================================================================
+
+def tokenize(text):
+    """Return the list of normalized terms of ``text``"""
+    return [t.lower() for t in TOKEN_RE.findall(text)]
+
+
+def parse_query(query):
+    """Split a query into clauses: ``('term', t)``, ``('prefix', p)`` or
+    ``('phrase', [t1, t2, ...])``"""
+    clauses = []
+    for phrase, word in QUERY_RE.findall(query):
+        if phrase:
+            tokens = tokenize(phrase)
+        elif word.endswith('*'):
+            tokens = tokenize(word[:-1])
+            if len(tokens) == 1:
+                clauses.append(('prefix', tokens[0]))
+                continue
+        else:
+            tokens = tokenize(word)
+        if len(tokens) == 1:
+            clauses.append(('term', tokens[0]))
+        elif tokens:
+            clauses.append(('phrase', tokens))
+    return clauses
+
+
+def make_snippet(text, terms, prefixes=(), width=240):
+    """Return an html fragment of ``text`` around the first matched term,
+    with all the matches highlighted"""
+
+    def matched(token):
+        token = token.lower()
+        return token in terms or any(token.startswith(p) for p in prefixes)
+
+    found = [m for m in TOKEN_RE.finditer(text) if matched(m.group())]
+    start = 0
+    if found:
+        start = max(0, found[0].start() - width // 3)
+        while start > 0 and not text[start - 1].isspace():
+            start -= 1
+    end = min(len(text), start + width)
+    while end < len(text) and not text[end].isspace():
+        end += 1
+
+    parts = [u'&hellip; '] if start else []
+    pos = start
+    for m in found:
+        if m.start() < start:
+            continue
+        if m.end() > end:
+            break
+        parts.append(escape(text[pos:m.start()]))
+        parts.append(u'<strong>%s</strong>' % escape(m.group()))
+        pos = m.end()
+    parts.append(escape(text[pos:end]))
+    if end < len(text):
+        parts.append(u' &hellip;')
+    return Markup(u''.join(parts))
+
+
+#===============================================================================
+# SEARCH CLASSES
+#===============================================================================
+
+class Hit(object):
+    """One search result"""
+
+    def __init__(self, url, title, score, snippet=u''):
+        self.url = url
+        self.title = title
+        self.score = score
+        self.snippet = snippet
+
+    def __repr__(self):
+        return "%s(%s, %.3f)" % (self.__class__.__name__, self.url, self.score)
+
+
+class SearchIndex(object):
+    """Inverted index of the pages of a :class:`wiki.Wiki`"""
+
+    K1 = 1.2
+    B = 0.75
+    MAX_EXPANSIONS = 100        # terms matched by a prefix query
+    SAVE_INTERVAL = 30          # seconds between snapshots
+
+    def __init__(self, wiki, path=None):
+        self.wiki = wiki
+        self.path = path
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._reset()
+        self._saved_at = 0
+        self._dirty = False
+        if path:
+            atexit.register(self.save)
+
+    def _reset(self):
+        self._docs = {}             # url -> {'hash', 'title', 'length', 'terms'}
+        self._postings = {}         # term -> {url: [positions]}
+        self._total_length = 0
+        self._generation = None     # catalog generation last synced
+        self._sorted_terms = None
+
+    # persistence
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                data = pickle.load(f)
+        except Exception:
+            return
+        if data.get('version') != INDEX_VERSION:
+            return
+        self._docs = data['docs']
+        self._postings = data['postings']
+        self._total_length = data['total_length']
+
+    def save(self):
+        """Write a snapshot of the index to disk"""
+        if not self.path:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            folder = os.path.dirname(self.path)
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+            data = {'version': INDEX_VERSION,
+                    'docs': self._docs,
+                    'postings': self._postings,
+                    'total_length': self._total_length}
+            tmp = '%s.%s.tmp' % (self.path, os.getpid())
+            with open(tmp, 'wb') as f:
+                pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, self.path)
+            self._saved_at = time.time()
+            self._dirty = False
+
+    def _changed(self):
+        self._dirty = True
+        if time.time() - self._saved_at > self.SAVE_INTERVAL:
+            self.save()
+
+    # indexing
+
+    def _add(self, url, raw, hash=None):
+        meta, body = self.wiki.markup.read_meta(raw)
+        title = meta_value(meta, 'title', default=url)
+        tags = meta_value(meta, 'tags', sep=u', ')
+        tokens = tokenize(title) + tokenize(tags) + tokenize(body)
+        positions = {}
+        for pos, token in enumerate(tokens):
+            positions.setdefault(token, []).append(pos)
+        for term, pos in positions.items():
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = {}
+                self._sorted_terms = None
+            postings[url] = pos
+        self._docs[url] = {'hash': hash or checksum(raw),
+                           'title': title,
+                           'length': len(tokens),
+                           'terms': tuple(positions)}
+        self._total_length += len(tokens)
+
+    def _remove(self, url):
+        doc = self._docs.pop(url, None)
+        if doc is None:
+            return
+        self._total_length -= doc['length']
+        for term in doc['terms']:
+            postings = self._postings.get(term)
+            if postings is None:
+                continue
+            postings.pop(url, None)
+            if not postings:
+                del self._postings[term]
+                self._sorted_terms = None
+
+    def _read(self, url):
+        path = self.wiki.path(url)
+        try:
+            with open(path, 'rU') as f:
+                return f.read().decode('utf-8')
+        except IOError:
+            return None
+
+    def update(self, url):
+        """(Re)index the page at ``url``"""
+        with self._lock:
+            self._load()
+            self._remove(url)
+            raw = self._read(url)
+            if raw is not None:
+                self._add(url, raw)
+            self._changed()
+
+    def remove(self, url):
+        with self._lock:
+            self._load()
+            self._remove(url)
+            self._changed()
+
+    def refresh(self):
+        """Reindex the pages whose hash in the catalog differs from ours"""
+        with self._lock:
+            self._load()
+            catalog = self.wiki.catalog
+            entries = catalog.entries()
+            if catalog.generation == self._generation:
+                return
+            changed = False
+            seen = set()
+            for entry in entries:
+                seen.add(entry.url)
+                doc = self._docs.get(entry.url)
+                if doc is not None and doc['hash'] == entry.hash:
+                    continue
+                self._remove(entry.url)
+                raw = self._read(entry.url)
+                if raw is not None:
+                    self._add(entry.url, raw)
+                changed = True
+            for url in set(self._docs) - seen:
+                self._remove(url)
+                changed = True
+            self._generation = catalog.generation
+            if changed:
+                self._changed()
+
+    # signal receivers
+
+    def on_page_saved(self, page, **extra):
+        self.update(page.url)
+
+    def on_page_moved(self, page, **extra):
+        self.remove(page.url)
+        self.update(extra['newurl'])
+
+    def on_page_deleted(self, page, **extra):
+        self.remove(page.url)
+
+    # querying
+
+    def _expand(self, prefix):
+        if self._sorted_terms is None:
+            self._sorted_terms = sorted(self._postings)
+        terms = []
+        idx = bisect.bisect_left(self._sorted_terms, prefix)
+        while idx < len(self._sorted_terms):
+            term = self._sorted_terms[idx]
+            if not term.startswith(prefix):
+                break
+            terms.append(term)
+            idx += 1
+        if len(terms) > self.MAX_EXPANSIONS:
+            terms.sort(key=lambda t: -len(self._postings[t]))
+            terms = terms[:self.MAX_EXPANSIONS]
+        return terms
+
+    def _bm25(self, term, tf, url):
+        n = len(self._docs)
+        df = len(self._postings[term])
+        idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+        avgdl = float(self._total_length) / n if n else 0
+        dl = self._docs[url]['length']
+        norm = self.K1 * (1 - self.B + self.B * dl / avgdl) if avgdl else self.K1
+        return idf * tf * (self.K1 + 1) / (tf + norm)
+
+    def _term_scores(self, term):
+        postings = self._postings.get(term, {})
+        return dict((url, self._bm25(term, len(pos), url))
+                    for url, pos in postings.items())
+
+    def _phrase_scores(self, tokens):
+        postings = [self._postings.get(t) for t in tokens]
+        if not all(postings):
+            return {}
+        urls = set(postings[0])
+        for p in postings[1:]:
+            urls &= set(p)
+        scores = {}
+        for url in urls:
+            starts = set(postings[0][url])
+            for offset, p in enumerate(postings[1:], 1):
+                starts &= set(pos - offset for pos in p[url])
+                if not starts:
+                    break
+            if starts:
+                scores[url] = sum(self._bm25(t, len(starts), url)
+                                  for t in tokens)
+        return scores
+
+    def _clause_scores(self, kind, value):
+        if kind == 'term':
+            return self._term_scores(value)
+        elif kind == 'prefix':
+            scores = {}
+            for term in self._expand(value):
+                for url, score in self._term_scores(term).items():
+                    scores[url] = scores.get(url, 0) + score
+            return scores
+        return self._phrase_scores(value)
+
+    def search(self, query, page=1, per_page=20):
+        """Return ``(hits, total)`` for the ``page`` of ranked results"""
+        clauses = parse_query(query)
+        if not clauses:
+            return [], 0
+        with self._lock:
+            self.refresh()
+            scores = None
+            for kind, value in clauses:
+                clause = self._clause_scores(kind, value)
+                if scores is None:
+                    scores = clause
+                else:
+                    scores = dict((url, score + clause[url])
+                                  for url, score in scores.items()
+                                  if url in clause)
+                if not scores:
+                    return [], 0
+            ranked = sorted(scores.items(),
+                            key=lambda i: (-i[1],
+                                           self._docs[i[0]]['title'].lower()))
+            total = len(ranked)
+            start = (max(page, 1) - 1) * per_page
+            ranked = ranked[start:start + per_page]
+            hits = [Hit(url, self._docs[url]['title'], score)
+                    for url, score in ranked]
+
+        terms = set()
+        prefixes = []
+        for kind, value in clauses:
+            if kind == 'prefix':
+                prefixes.append(value)
+            elif kind == 'phrase':
+                terms.update(value)
+            else:
+                terms.add(value)
+        for hit in hits:
+            raw = self._read(hit.url) or u''
+            body = self.wiki.markup.read_meta(raw)[1]
+            hit.snippet = make_snippet(body, terms, prefixes)
+        return hits, total
+
+
+#===============================================================================
+# MAIN
+#===============================================================================
+
+if __name__ == "__main__":
+    print(__doc__)
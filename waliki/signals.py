@@ -28,8 +28,12 @@ from flask.signals import Namespace
 wiki_signals = Namespace()
 
 page_saved = wiki_signals.signal('page-saved')
+page_moved = wiki_signals.signal('page-moved')
+page_deleted = wiki_signals.signal('page-deleted')
 pre_edit = wiki_signals.signal('pre-edit')
 pre_display = wiki_signals.signal('pre-display')
+collect_stats = wiki_signals.signal('collect-stats')
+display_etag = wiki_signals.signal('display-etag')
 
 
 #===============================================================================
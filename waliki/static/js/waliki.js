@@ -10,4 +10,20 @@ $(document).ready(function() {
         $elem.show();
     });
 
+    // cached pages carry the relative date of when they were rendered
+    var units = [[31536000, 'year'], [2592000, 'month'], [604800, 'week'],
+                 [86400, 'day'], [3600, 'hour'], [60, 'minute'], [1, 'second']];
+    $('time.relative-date').each(function(idx, elem){
+        var when = Date.parse($(elem).attr('datetime'));
+        if (isNaN(when)) return;
+        var seconds = Math.max(Math.floor((new Date() - when) / 1000), 0);
+        for (var i = 0; i < units.length; i++) {
+            if (seconds >= units[i][0] || units[i][0] == 1) {
+                var count = Math.floor(seconds / units[i][0]);
+                $(elem).text(count + ' ' + units[i][1] + (count == 1 ? '' : 's') + ' ago');
+                break;
+            }
+        }
+    });
+
 });
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013-2014, Martín Gaitán
+# Copyright (c) 2012-2013, Alexander Jung-Loddenkemper
+# This file is part of Waliki (http://waliki.nqnwebs.com/)
+# License: BSD (https://github.com/mgaitan/waliki/blob/master/LICENSE)
+
+#===============================================================================
+# DOCS
+#===============================================================================
+
+"""Tag index
+
+Every page of the catalog gets a small integer id and every tag a bitset
+(a python long) with the bits of the pages tagged with it. So
+intersections, unions and exclusions of tags are just ``&``, ``|`` and
+``& ~`` over integers.
+
+"""
+
+#===============================================================================
+# IMPORTS
+#===============================================================================
+
+import threading
+
+
+#===============================================================================
+# FUNCTIONS
+#===============================================================================
+
+def normalize(tag):
+    return u' '.join(tag.split()).lower()
+
+
+def split_tags(tags):
+    """Return the list of normalized tags of a comma separated string"""
+    result = []
+    for tag in tags.split(','):
+        tag = normalize(tag)
+        if tag and tag not in result:
+            result.append(tag)
+    return result
+
+
+def iter_bits(bits):
+    """Yield the position of every bit set in ``bits``"""
+    while bits:
+        low = bits & -bits
+        yield low.bit_length() - 1
+        bits ^= low
+
+
+#===============================================================================
+# TAG INDEX
+#===============================================================================
+
+class TagIndex(object):
+    """Tags of the pages in a :class:`catalog.Catalog`.
+
+    It follows the catalog generation and only reindexes the entries
+    whose tags changed.
+
+    """
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self._lock = threading.RLock()
+        self._generation = None
+        self._ids = {}          # url -> page id
+        self._entries = []      # page id -> catalog entry (None if free)
+        self._free = []         # ids of removed pages, to be reused
+        self._raw = {}          # url -> tags string as indexed
+        self._bits = {}         # tag -> bitset of page ids
+        self._counts = {}       # tag -> number of pages
+        self._names = {}        # tag -> name as written the first time
+
+    def _untag(self, url):
+        pid = self._ids[url]
+        for tag in split_tags(self._raw[url]):
+            self._bits[tag] &= ~(1 << pid)
+            self._counts[tag] -= 1
+            if not self._counts[tag]:
+                del self._bits[tag], self._counts[tag], self._names[tag]
+
+    def _tag(self, entry):
+        pid = self._ids[entry.url]
+        for original in entry.tags.split(','):
+            tag = normalize(original)
+            if not tag or self._bits.get(tag, 0) & (1 << pid):
+                continue
+            self._bits[tag] = self._bits.get(tag, 0) | (1 << pid)
+            self._counts[tag] = self._counts.get(tag, 0) + 1
+            self._names.setdefault(tag, original.strip())
+        self._raw[entry.url] = entry.tags
+
+    def _add(self, entry):
+        if self._free:
+            pid = self._free.pop()
+            self._entries[pid] = entry
+        else:
+            pid = len(self._entries)
+            self._entries.append(entry)
+        self._ids[entry.url] = pid
+        self._tag(entry)
+
+    def _remove(self, url):
+        self._untag(url)
+        pid = self._ids.pop(url)
+        del self._raw[url]
+        self._entries[pid] = None
+        self._free.append(pid)
+
+    def refresh(self):
+        with self._lock:
+            entries = self.catalog.entries()
+            if self.catalog.generation == self._generation:
+                return
+            seen = set()
+            for entry in entries:
+                seen.add(entry.url)
+                if entry.url not in self._ids:
+                    self._add(entry)
+                    continue
+                self._entries[self._ids[entry.url]] = entry
+                if self._raw[entry.url] != entry.tags:
+                    self._untag(entry.url)
+                    self._tag(entry)
+            for url in set(self._ids) - seen:
+                self._remove(url)
+            self._generation = self.catalog.generation
+
+    # queries
+
+    def counts(self):
+        """Return a dict ``{tag: number of pages}``"""
+        with self._lock:
+            self.refresh()
+            return dict((self._names[tag], count)
+                        for tag, count in self._counts.items())
+
+    def query(self, all=(), any=(), exclude=()):
+        """Return the catalog entries tagged with every tag in ``all``,
+        at least one of ``any`` and none of ``exclude``"""
+        with self._lock:
+            self.refresh()
+            if all:
+                bits = -1
+                for tag in all:
+                    bits &= self._bits.get(normalize(tag), 0)
+            else:
+                bits = (1 << len(self._entries)) - 1
+            if any:
+                union = 0
+                for tag in any:
+                    union |= self._bits.get(normalize(tag), 0)
+                bits &= union
+            for tag in exclude:
+                bits &= ~self._bits.get(normalize(tag), 0)
+            pages = [self._entries[pid] for pid in iter_bits(bits)]
+        return sorted([p for p in pages if p is not None],
+                      key=lambda x: x.title.lower())
+
+
+#===============================================================================
+# MAIN
+#===============================================================================
+
+if __name__ == "__main__":
+    print(__doc__)
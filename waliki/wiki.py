@@ -20,6 +20,7 @@
 
 import re
 import os
+import json
 import shutil
 import hashlib
 
@@ -27,6 +28,58 @@ from flask import abort
 from extensions.cache import cache
 
 import markup
+from renderpool import RenderError
+from catalog import Catalog
+from search import SearchIndex
+from tags import TagIndex
+
+
+#===============================================================================
+# CONSTANTS
+#===============================================================================
+
+# rendered html is cached by content, so it never gets stale
+RENDER_CACHE_TIMEOUT = 60 * 60 * 24 * 30
+
+
+#===============================================================================
+# URLS
+#===============================================================================
+
+class ForbiddenUrlError(ValueError):
+
+    def __init__(self, invalidpart, url):
+        self.invalidpart = invalidpart
+        self.url = url
+        super(ForbiddenUrlError, self).__init__(
+            "You can't create a page inside '{0}': {1}".format(invalidpart, url)
+        )
+
+    @property
+    def redirect(self):
+        if self.invalidpart.startswith("_"):
+            idx = self.url.index(self.invalidpart)
+            return "/" + self.url[:idx]
+        return self.invalidpart
+
+
+def urlify(url, protect_specials_url=True):
+    # Cleans the url and corrects various errors.
+    # Remove multiple spaces and leading and trailing spaces
+    if protect_specials_url:
+        if re.match(r'^(?i)(user|tag|create|search|index)', url):
+            invalid = url.replace('\\\\', '/').replace('\\', '/').split("/", 1)[0]
+            raise ForbiddenUrlError(invalid, url)
+        for p in url.replace('\\\\', '/').replace('\\', '/').split("/"):
+            if p in ("_edit"):
+                raise ForbiddenUrlError(p, url)
+
+    pretty_url = re.sub('[ ]{2,}', ' ', url).strip()
+    pretty_url = pretty_url.lower().replace('_', '-').replace(' ', '-')
+    # Corrects Windows style folders
+    pretty_url = pretty_url.replace('\\\\', '/').replace('\\', '/')
+    return pretty_url
+
 
 
 #===============================================================================
@@ -34,23 +87,57 @@ import markup
 #===============================================================================
 
 class Page(object):
-    def __init__(self, path, url, new=False, markup=markup.Markdown):
+    def __init__(self, path, url, new=False, markup=markup.Markdown,
+                 wiki=None):
         self.path = path
         self.url = url
         self.markup = markup
+        self.wiki = wiki
         self._meta = {}
+        self._html = None
+        self._from_file = False
         if not new:
             self.load()
-            self.render()
 
     def load(self, content=None):
+        """Read the source and its header. The HTML is rendered
+        the first time it's needed"""
+        self._from_file = not content
         if not content:
             with open(self.path, 'rU') as f:
                 content = f.read().decode('utf-8')
         self.content = self.markup(content)
+        self._meta, self.body = self.markup.read_meta(content)
+        self._html = None
+
+    @property
+    def _artifacts(self):
+        # only the content on disk has artifacts (i.e. not old versions)
+        if self.wiki is not None and self._from_file:
+            return self.wiki.artifacts
+        return None
 
     def render(self):
-        self._html, self.body, self._meta = self.content.process()
+        key = self.content.cache_key()
+        artifacts = self._artifacts
+        if artifacts is not None:
+            html = artifacts.read(self.url, key)
+            if html is not None:
+                self._html = html
+                return
+        html = cache.get(key)
+        if html is None:
+            try:
+                html = self.content.render()
+            except RenderError as e:
+                # shown, but never cached: it may work next time
+                self._html = e.html
+                return
+            cache.set(key, html, timeout=RENDER_CACHE_TIMEOUT)
+        self._html = html
+        if artifacts is not None:
+            # stale or missing, i.e. the file was edited outside waliki
+            artifacts.write(self.url, key, html, self._meta)
 
     def __repr__(self):
         return "%s(%s)" % (self.__class__.__name__, self.path)
@@ -68,7 +155,10 @@ class Page(object):
             f.write(self.body.replace('\r\n', os.linesep).encode('utf-8'))
         if update:
             self.load()
+            # render on save, so displaying never has to
             self.render()
+        if self.wiki is not None:
+            self.wiki.catalog.update(self.url, self._meta)
 
     @property
     def meta(self):
@@ -85,15 +175,17 @@ class Page(object):
 
     @property
     def html(self):
+        if self._html is None:
+            self.render()
         return self._html
 
-    @cache.memoize()
     def __html__(self):
         return self.html
 
     def delete_cache(self):
-        cache.delete(self.__html__.make_cache_key(self.__html__.uncached,
-                                                  self))
+        # the render cache is keyed by content, nothing to invalidate.
+        # Kept for extensions written against the old memoized __html__
+        pass
 
     @property
     def title(self):
@@ -113,9 +205,8 @@ class Page(object):
 
     @property
     def checksum(self):
-        seed = (self.html.encode("utf8") +
-                self.title.encode("utf8") +
-                unicode(self.tags).encode("utf8"))
+        # the source already includes title and tags in its header
+        seed = self.content.raw_content.encode("utf8")
         return hashlib.sha256(seed).hexdigest()
 
     @checksum.setter
@@ -123,10 +214,78 @@ class Page(object):
         pass
 
 
+class Artifacts(object):
+    """Rendered html of pages, with a json sidecar holding the stamp
+    (:meth:`markup.Markup.cache_key`) of the source it was made from and
+    its metadata"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def _paths(self, url):
+        base = os.path.join(self.root, url)
+        return base + '.html', base + '.json'
+
+    def _write_file(self, path, data):
+        tmp = '%s.%s.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(data)
+        os.rename(tmp, path)
+
+    def read(self, url, stamp):
+        """Return the html of ``url`` if it was rendered from a source
+        with the given stamp, or None"""
+        html_path, meta_path = self._paths(url)
+        try:
+            with open(meta_path) as f:
+                sidecar = json.loads(f.read())
+            if sidecar.get('stamp') != stamp:
+                return None
+            with open(html_path) as f:
+                return f.read().decode('utf-8')
+        except (IOError, ValueError):
+            return None
+
+    def write(self, url, stamp, html, meta):
+        html_path, meta_path = self._paths(url)
+        folder = os.path.dirname(html_path)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self._write_file(html_path, html.encode('utf-8'))
+        # the sidecar goes last: it's what validates the html
+        self._write_file(meta_path, json.dumps({'stamp': stamp,
+                                                'meta': meta}))
+
+    def remove(self, url):
+        for path in self._paths(url):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def move(self, url, newurl):
+        # the stamp doesn't depend on the url, so they are still valid
+        for path, newpath in zip(self._paths(url), self._paths(newurl)):
+            if not os.path.exists(path):
+                continue
+            folder = os.path.dirname(newpath)
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+            shutil.move(path, newpath)
+
+
 class Wiki(object):
-    def __init__(self, root, markup=markup.Markdown):
+    def __init__(self, root, markup=markup.Markdown, cache_dir=None):
         self.root = root
         self.markup = markup
+        catalog_path = index_path = None
+        if cache_dir:
+            catalog_path = os.path.join(cache_dir, 'catalog', 'pages.json')
+            index_path = os.path.join(cache_dir, 'search', 'index.pickle')
+        self.catalog = Catalog(self, catalog_path)
+        self.artifacts = None
+        if cache_dir:
+            self.artifacts = Artifacts(os.path.join(cache_dir, 'rendered'))
+        self.search_index = SearchIndex(self, index_path)
+        self.tag_index = TagIndex(self.catalog)
 
     def path(self, url):
         return os.path.join(self.root, url + self.markup.EXTENSION)
@@ -136,11 +295,26 @@ class Wiki(object):
         return os.path.exists(path)
 
     def get(self, url):
-        path = os.path.join(self.root, url + self.markup.EXTENSION)
+        path = self.path(url)
         if self.exists(url):
-            return Page(path, url, markup=self.markup)
+            return Page(path, url, markup=self.markup, wiki=self)
         return None
 
+    def fingerprint(self, url):
+        """Return ``(hash, mtime)`` of the page source without reading it,
+        or None if the page doesn't exist"""
+        try:
+            st = os.stat(self.path(url))
+        except OSError:
+            return None
+        entry = self.catalog.get(url)
+        if (entry is None or entry.mtime != st.st_mtime or
+                entry.size != st.st_size):
+            # changed behind our back (git pull, another editor...)
+            self.catalog.update(url)
+            entry = self.catalog.get(url)
+        return entry.hash, st.st_mtime
+
     def get_or_404(self, url):
         page = self.get(url)
         if page:
@@ -151,7 +325,7 @@ class Wiki(object):
         path = self.path(url)
         if self.exists(url):
             return False
-        return Page(path, url, new=True, markup=self.markup)
+        return Page(path, url, new=True, markup=self.markup, wiki=self)
 
     def move(self, url, newurl):
         fromfile = os.path.join(self.root, url) + self.markup.EXTENSION
@@ -160,78 +334,68 @@ class Wiki(object):
         if not os.path.exists(todir):
             os.makedirs(todir)
         shutil.move(fromfile, tofile)
+        self.catalog.move(url, newurl)
+        if self.artifacts is not None:
+            self.artifacts.move(url, newurl)
 
     def delete(self, url):
         path = self.path(url)
         if not self.exists(url):
             return False
         os.remove(path)
+        self.catalog.remove(url)
+        if self.artifacts is not None:
+            self.artifacts.remove(url)
         return True
 
+    def walk(self):
+        """Yield ``(path, url)`` for every page file under the root"""
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        ext_len = len(self.markup.EXTENSION)
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            # skip .git, .hg and friends
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            for name in filenames:
+                if not name.endswith(self.markup.EXTENSION):
+                    continue
+                fullname = os.path.join(dirpath, name)
+                url = os.path.relpath(fullname, self.root)[:-ext_len]
+                yield fullname, url.replace('\\', '/')
+
     def index(self, attr=None):
+        """Return the catalog entries of all pages sorted by title.
+
+        If ``attr`` is given, return a dict of entries keyed by that
+        attribute instead.
 
-        def _walk(directory, path_prefix=()):
-            if not os.path.exists(directory):
-                os.makedirs(directory)
-            for name in os.listdir(directory):
-                fullname = os.path.join(directory, name)
-                if os.path.isdir(fullname):
-                    _walk(fullname, path_prefix + (name,))
-                elif name.endswith(self.markup.EXTENSION):
-                    ext_len = len(self.markup.EXTENSION)
-                    if not path_prefix:
-                        url = name[:-ext_len]
-                    else:
-                        url = os.path.join(path_prefix[0], name[:-ext_len])
-
-                    pages.append(Page(fullname, url.replace('\\', '/'),
-                                      markup=self.markup))
+        """
+        entries = self.catalog.entries()
         if attr:
-            pages = {}
-        else:
-            pages = []
-        _walk(self.root)
-        if not attr:
-            return sorted(pages, key=lambda x: x.title.lower())
-        return pages
+            return dict((getattr(entry, attr), entry) for entry in entries)
+        return sorted(entries, key=lambda x: x.title.lower())
 
     def get_by_title(self, title):
-        pages = self.index(attr='title')
-        return pages.get(title)
+        entry = self.index(attr='title').get(title)
+        if entry is None:
+            return None
+        return self.get(entry.url)
 
     def get_tags(self):
-        pages = self.index()
-        tags = {}
-        for page in pages:
-            pagetags = page.tags.split(',')
-            for tag in pagetags:
-                tag = tag.strip()
-                if tag == '':
-                    continue
-                elif tags.get(tag):
-                    tags[tag].append(page)
-                else:
-                    tags[tag] = [page]
-        return tags
+        """Return a dict ``{tag: number of pages tagged}``"""
+        return self.tag_index.counts()
 
     def index_by_tag(self, tag):
-        pages = self.index()
-        tagged = []
-        for page in pages:
-            if tag in page.tags:
-                tagged.append(page)
-        return sorted(tagged, key=lambda x: x.title.lower())
-
-    def search(self, term, attrs=['title', 'tags', 'body']):
-        pages = self.index()
-        regex = re.compile(term)
-        matched = []
-        for page in pages:
-            for attr in attrs:
-                if regex.search(getattr(page, attr)):
-                    matched.append(page)
-                    break
-        return matched
+        return self.tag_index.query(all=[tag])
+
+    def query_tags(self, all=(), any=(), exclude=()):
+        """Return the pages tagged with every tag in ``all``, at least
+        one of ``any`` and none of ``exclude``"""
+        return self.tag_index.query(all, any, exclude)
+
+    def search(self, term, page=1, per_page=20):
+        """Return ``(hits, total)`` for the given page of results"""
+        return self.search_index.search(term, page, per_page)
 
 
 #===============================================================================